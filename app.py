@@ -1,36 +1,1230 @@
-from flask import Flask, render_template, request, jsonify
+import time
+BOOT_STARTED = time.perf_counter() # 啟動計時的起點：模組開始匯入
+
+from flask import Flask, Response, g, render_template, request, jsonify, send_from_directory
+from markupsafe import Markup, escape
 from flask_socketio import SocketIO, emit
-import google.generativeai as genai
 import os
-import time
+import random
+import socket
+import sys
+import uuid
 import asyncio
-from threading import Thread
+import atexit
+import bisect
+import gzip
+import hashlib
+import hmac
+import json
+import math
+import sqlite3
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
 import logging
 
+try:
+    import brotli # 可選：未安裝時首頁只提供 gzip 壓縮
+except ImportError:
+    brotli = None
+
 # 設置日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 啟動計時（秒，相對於 BOOT_STARTED）：匯入、模組就緒、第一個請求、SDK 匯入與預熱，由 /api/health 回報
+startup_timings = {
+    'imports_seconds': round(time.perf_counter() - BOOT_STARTED, 3),
+    'module_ready_seconds': None,
+    'first_request_seconds': None,
+    'first_request_duration': None,
+    'genai_import_seconds': None,
+    'warmup_seconds': None
+}
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
-socketio = SocketIO(app, cors_allowed_origins="*")
+# 多 worker / 多節點部署時設定訊息佇列（例如 redis://redis:6379/0），任一 worker 發出的事件都能送達客戶端
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE or None)
+
+# 模型後端：gemini（預設）或 fake（離線假模型，不需要 API 金鑰，供本機測試與壓力測試使用）
+MODEL_BACKEND = os.getenv('MODEL_BACKEND', 'gemini')
 
-# 配置 Gemini API
+# 配置 Gemini API：SDK 匯入約需一秒，延後到第一次需要模型時（或背景預熱時）才匯入與設定；
+# 缺少金鑰時頁面照常提供，只有模型呼叫會失敗，狀態可由 /api/health 查詢
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    logger.error("GEMINI_API_KEY 環境變數未設置")
-    raise ValueError("請設置 GEMINI_API_KEY 環境變數")
+# 模型狀態：cold（尚未載入）/ warming / ready / error
+model_status = {'state': 'cold', 'error': None}
+if MODEL_BACKEND == 'gemini' and not GEMINI_API_KEY:
+    logger.error("GEMINI_API_KEY 環境變數未設置，模型呼叫將會失敗")
+    model_status.update(state='error', error='GEMINI_API_KEY 環境變數未設置')
 
-genai.configure(api_key=GEMINI_API_KEY)
+# 啟動後在背景預熱模型：匯入 SDK、建立模型物件並預先建立連線，讓第一個對話不必等待
+MODEL_WARMUP = os.getenv('MODEL_WARMUP', 'true').lower() == 'true'
+# 預熱前先等待的秒數，讓剛開機時的第一個頁面請求優先完成
+MODEL_WARMUP_DELAY_SECONDS = float(os.getenv('MODEL_WARMUP_DELAY_SECONDS', 1))
 
-class ConversationManager:
+_genai = None
+_genai_lock = Lock()
+
+def load_genai():
+    """第一次需要時才匯入並設定 Gemini SDK，之後重複使用同一個模組"""
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            if not GEMINI_API_KEY:
+                raise RuntimeError("請設置 GEMINI_API_KEY 環境變數")
+            started = time.perf_counter()
+            import google.generativeai as genai
+            genai.configure(api_key=GEMINI_API_KEY)
+            startup_timings['genai_import_seconds'] = round(time.perf_counter() - started, 3)
+            _genai = genai
+    return _genai
+
+def parse_call_type_map(spec, cast=str):
+    """解析 'narrator=值,outline=值' 形式的設定，依呼叫類型（outline / dialogue / narrator / summary）分別指定"""
+    result = {}
+    for item in spec.split(','):
+        call_type, _, value = item.partition('=')
+        if call_type.strip() and value.strip():
+            result[call_type.strip()] = cast(value.strip())
+    return result
+
+# 模型路由：預設模型，以及依呼叫類型改用的模型；旁白、大綱與摘要的輸出很短，交給不需思考的快速模型
+MODEL_NAME = os.getenv('MODEL_NAME', 'models/gemini-2.5-flash-preview-04-17-thinking')
+MODEL_ROUTES = parse_call_type_map(os.getenv(
+    'MODEL_ROUTES', 'outline=models/gemini-2.0-flash,narrator=models/gemini-2.0-flash,summary=models/gemini-2.0-flash'
+))
+# 依呼叫類型指定的 temperature（未列出的使用模型預設值），例如 dialogue=0.9,summary=0.3
+MODEL_TEMPERATURES = parse_call_type_map(os.getenv('MODEL_TEMPERATURES', ''), float)
+# 思考模型的思考權杖預算：目前的 SDK 無法直接設定思考預算，改為加在 max_output_tokens 上，
+# 思考與輸出共用同一個上限，避免思考用完額度而沒有輸出
+MODEL_THINKING_BUDGET = int(os.getenv('MODEL_THINKING_BUDGET', 1024))
+
+# 串流模式：逐段將模型輸出推送到前端，降低首字出現的等待時間
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
+
+# 排程設定：同時進行的對話會話上限，以及同時進行中的模型呼叫上限
+MAX_ACTIVE_SESSIONS = int(os.getenv('MAX_ACTIVE_SESSIONS', 200))
+MAX_INFLIGHT_MODEL_CALLS = int(os.getenv('MAX_INFLIGHT_MODEL_CALLS', 16))
+
+# 管線化回合：第 N 輪的旁白與第 N+1 輪角色1的生成同時進行（角色1的提示詞不會讀取旁白）
+PIPELINE_ROUNDS = os.getenv('PIPELINE_ROUNDS', 'true').lower() == 'true'
+# 每則訊息之間的呈現間隔（秒），預設 0 表示全速進行；以非阻塞的 asyncio.sleep 實作，不會佔住工作執行緒
+TURN_PACING_SECONDS = float(os.getenv('TURN_PACING_SECONDS', 0))
+
+# 提示詞視窗：角色提示詞只逐字帶入最近 N 則對話，更早的內容摺疊進滾動摘要（0 表示不摺疊）
+PROMPT_HISTORY_WINDOW = int(os.getenv('PROMPT_HISTORY_WINDOW', 12))
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv('HISTORY_SUMMARY_MAX_CHARS', 300))
+
+# 各呼叫類型在提示詞中要求的字數上限，用來換算 max_output_tokens；角色發言改用會話的 word_limit
+CALL_TYPE_MAX_CHARS = {'outline': 200, 'narrator': 30, 'summary': HISTORY_SUMMARY_MAX_CHARS}
+
+# 模型回應快取：只有列在 LLM_CACHE_CALL_TYPES 的呼叫類型（outline / dialogue / narrator / summary）會使用快取
+LLM_CACHE_CALL_TYPES = {t.strip() for t in os.getenv('LLM_CACHE_CALL_TYPES', 'outline').split(',') if t.strip()}
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 1024))
+LLM_CACHE_TTL_SECONDS = float(os.getenv('LLM_CACHE_TTL_SECONDS', 86400))
+LLM_CACHE_DB = os.getenv('LLM_CACHE_DB', '') # 設定路徑即啟用 SQLite 持久層，重新啟動後仍可命中
+
+# 會話狀態儲存：留空為單一程序記憶體；sqlite:///路徑 或 redis://主機:埠/資料庫 可讓多個 worker 共用
+SESSION_STORE_URL = os.getenv('SESSION_STORE_URL', '')
+# 驅動會話的租約秒數：持有租約的 worker 才能推進該會話，租約過期後其他 worker 可以接手
+SESSION_LEASE_SECONDS = float(os.getenv('SESSION_LEASE_SECONDS', 60))
+# 共用儲存時持有租約的 worker 輪詢控制紀錄（其他 worker 收到的停止／暫停／繼續要求）的間隔秒數
+CONTROL_POLL_SECONDS = float(os.getenv('CONTROL_POLL_SECONDS', 1))
+# 斷線寬限期（秒）：客戶端斷線後保留會話，期間重新連線可以接續並補送漏掉的訊息；0 表示斷線立即刪除
+RESUME_GRACE_SECONDS = float(os.getenv('RESUME_GRACE_SECONDS', 120))
+# 會話記憶體上限：非執行中的會話閒置超過 TTL 秒即移除；總數超過上限時依最近使用順序 (LRU) 淘汰
+SESSION_IDLE_TTL_SECONDS = float(os.getenv('SESSION_IDLE_TTL_SECONDS', 1800))
+MAX_STORED_SESSIONS = int(os.getenv('MAX_STORED_SESSIONS', 1000))
+
+# 對話逐字稿持久儲存：設定 SQLite 路徑即啟用（WAL 模式、訊息只附加），重新啟動或部署後仍可查詢；
+# 結束的會話會卸載出記憶體，查詢時再讀回
+TRANSCRIPT_DB = os.getenv('TRANSCRIPT_DB', '')
+# 批次寫入：累積的寫入每 TRANSCRIPT_FLUSH_SECONDS 秒、或達到 TRANSCRIPT_BATCH_SIZE 筆時，以單一交易寫入
+TRANSCRIPT_FLUSH_SECONDS = float(os.getenv('TRANSCRIPT_FLUSH_SECONDS', 0.5))
+TRANSCRIPT_BATCH_SIZE = int(os.getenv('TRANSCRIPT_BATCH_SIZE', 256))
+
+class Message:
+    """
+    精簡的訊息紀錄（__slots__），對話與旁白共用；支援 msg['role'] 形式的讀取，與原本的 dict 用法相容。
+    seq 是會話內從 1 開始遞增的序號，由 MessageLog 在加入時指定，客戶端以它做增量同步與去重。
+    """
+    __slots__ = ('type', 'role', 'content', 'round', 'is_role1', 'seq')
+    
+    def __init__(self, type, content, round=None, role=None, is_role1=None):
+        self.type = type
+        self.role = role
+        self.content = content
+        self.round = round
+        self.is_role1 = is_role1
+        self.seq = None
+    
+    def __getitem__(self, key):
+        return getattr(self, key)
+    
+    def to_dict(self):
+        if self.type == 'dialogue':
+            return {'seq': self.seq, 'type': 'dialogue', 'role': self.role, 'content': self.content, 'round': self.round, 'is_role1': self.is_role1}
+        return {'seq': self.seq, 'type': self.type, 'content': self.content, 'round': self.round}
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['type'], data['content'], data.get('round'), data.get('role'), data.get('is_role1'))
+
+class MessageLog:
+    """
+    會話唯一的一份訊息儲存；對話訊息另以位置索引記錄，conversation_history 只是檢視而非副本。
+    分支會話（fork）以 base 共用來源會話的前 base_len 則訊息，不複製；之後的訊息才寫入自己的 records。
+    """
+    
+    def __init__(self, messages=(), base=None, base_len=0):
+        self.base = base
+        self.base_len = base_len
+        self.records = []
+        # 對話訊息在整個紀錄（含共用前綴）中的位置；前綴部分只複製精簡的索引陣列
+        self.dialogue_index = array('I')
+        if base is not None:
+            self.dialogue_index = base.dialogue_index[:bisect.bisect_left(base.dialogue_index, base_len)]
+        for message in messages:
+            self.append(message)
+    
+    def append(self, message):
+        # 訊息只會附加不會刪除，序號即位置加一，since() 因此可以直接切片；共用的前綴因此也不會被改動
+        position = len(self)
+        message.seq = position + 1
+        if message.type == 'dialogue':
+            self.dialogue_index.append(position)
+        self.records.append(message)
+    
+    def fork(self, length):
+        """以前 length 則訊息為前綴的新紀錄：共用同一批 Message 物件，之後各自附加"""
+        if self.base is not None and length <= self.base_len:
+            return self.base.fork(length)
+        return MessageLog(base=self, base_len=length)
+    
+    def __len__(self):
+        return self.base_len + len(self.records)
+    
+    def __iter__(self):
+        if self.base is None:
+            return iter(self.records)
+        return chain(islice(self.base, self.base_len), self.records)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < self.base_len:
+            return self.base[index]
+        return self.records[index - self.base_len]
+    
+    def history(self):
+        return DialogueView(self)
+    
+    def to_list(self):
+        return [message.to_dict() for message in self]
+    
+    def since(self, seq):
+        """序號大於 seq 的訊息（增量同步用）"""
+        start = max(seq, 0)
+        if start >= self.base_len:
+            return [message.to_dict() for message in self.records[start - self.base_len:]]
+        return [message.to_dict() for message in islice(self, start, None)]
+
+class DialogueView(Sequence):
+    """MessageLog 中對話訊息的唯讀檢視，支援 len、索引與切片"""
+    
+    def __init__(self, log):
+        self.log = log
+    
+    def __len__(self):
+        return len(self.log.dialogue_index)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.log[i] for i in self.log.dialogue_index[index]]
+        return self.log[self.log.dialogue_index[index]]
+
+# 共用儲存中只增不改的欄位：每個項目各自存放，儲存時只附加上次之後新增的部分
+APPEND_ONLY_KEYS = ('messages', 'timeline')
+
+def conversation_meta(conversation):
+    """共用儲存的會話列：訊息與時間軸以外的欄位（conversation_history 是檢視，不另外存）"""
+    return {
+        key: value for key, value in conversation.items()
+        if key != 'conversation_history' and key not in APPEND_ONLY_KEYS
+    }
+
+def appended_entries(conversation, key, count):
+    """只增不改的欄位在前 count 個項目之後新增的部分（可 JSON 序列化）"""
+    if key == 'messages':
+        return conversation['messages'].since(count)
+    return conversation.get(key, [])[count:]
+
+def conversation_from_dict(data):
+    log = MessageLog(Message.from_dict(message) for message in data['messages'])
+    data['messages'] = log
+    data['conversation_history'] = log.history()
+    return data
+
+def current_rss_bytes():
+    """目前程序的常駐記憶體 (RSS)；無 /proc 的平台退而回報峰值"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class MemorySessionStore:
+    """單一程序內的會話儲存（預設），本程序永遠持有所有會話的租約"""
+    shared = False
+    
     def __init__(self):
-        self.conversations = {}
-        # 使用 Gemini 1.5 Flash 模型，針對速度進行優化
-        self.model = genai.GenerativeModel('models/gemini-2.5-flash-preview-04-17-thinking') 
+        self.sessions = OrderedDict()
+        self.controls = {}
+    
+    def load(self, session_id):
+        return self.sessions.get(session_id)
+    
+    def save(self, session_id, conversation):
+        self.sessions[session_id] = conversation
+    
+    def delete(self, session_id):
+        self.sessions.pop(session_id, None)
+        self.controls.pop(session_id, None)
+    
+    def expire(self, older_than):
+        """記憶體後端的過期由 ConversationManager.evict_idle 處理"""
+        pass
+    
+    def acquire_lease(self, session_id, owner, ttl):
+        return True
+    
+    def renew_lease(self, session_id, owner, ttl):
+        return True
+    
+    def release_lease(self, session_id, owner):
+        pass
+    
+    def is_leased(self, session_id):
+        return False
+    
+    def get_control(self, session_id):
+        return self.controls.get(session_id)
+    
+    def set_control(self, session_id, **fields):
+        """合併寫入會話的控制紀錄；值為 None 的欄位會被移除"""
+        control = self.controls.setdefault(session_id, {})
+        control.update(fields)
+        for key in [key for key, value in control.items() if value is None]:
+            del control[key]
+        if not control:
+            del self.controls[session_id]
+    
+    def clear_control(self, session_id):
+        self.controls.pop(session_id, None)
+
+class SQLiteSessionStore:
+    """以 SQLite（WAL 模式）共用會話狀態與租約，適合同一台主機上的多個 worker"""
+    shared = True
+    
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        # 訊息與時間軸每個項目一列、只新增不修改；generation 為會話建立時間，同一個 ID 重新開始後不會混用舊紀錄
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS session_log (session_id TEXT NOT NULL, generation REAL NOT NULL, stream TEXT NOT NULL, '
+            'idx INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (session_id, generation, stream, idx)) WITHOUT ROWID'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS leases (session_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        # 控制紀錄（停止／暫停要求、斷線時間）與會話狀態分開存放，驅動中的 worker 寫回進度時不會覆蓋
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS controls (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self._lock = Lock()
+    
+    def load(self, session_id):
+        with self._lock:
+            row = self.db.execute('SELECT data FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                return None
+            data = json.loads(row[0])
+            entries = self.db.execute(
+                'SELECT stream, data FROM session_log WHERE session_id = ? AND generation = ? ORDER BY stream, idx',
+                (session_id, data.get('created_at', 0))
+            ).fetchall()
+        for key in APPEND_ONLY_KEYS:
+            data.setdefault(key, []) # 舊版整份存放的會話列本身就帶有訊息
+        for stream, entry in entries:
+            data[stream].append(json.loads(entry))
+        return conversation_from_dict(data)
+    
+    def save(self, session_id, conversation):
+        """會話列整列改寫（只含較小的欄位），訊息與時間軸只附加新增的項目，每次寫入量不隨對話長度增長"""
+        generation = conversation.get('created_at', 0)
+        data = json.dumps(conversation_meta(conversation), ensure_ascii=False)
+        with self._lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                stored = dict(self.db.execute(
+                    'SELECT stream, MAX(idx) + 1 FROM session_log WHERE session_id = ? AND generation = ? GROUP BY stream',
+                    (session_id, generation)
+                ).fetchall())
+                if not stored:
+                    # 同一個 ID 重新開始：移除前一個會話留下的紀錄
+                    self.db.execute(
+                        'DELETE FROM session_log WHERE session_id = ? AND generation != ?', (session_id, generation)
+                    )
+                for key in APPEND_ONLY_KEYS:
+                    count = stored.get(key, 0)
+                    self.db.executemany(
+                        'INSERT INTO session_log (session_id, generation, stream, idx, data) VALUES (?, ?, ?, ?, ?)',
+                        [(session_id, generation, key, count + i, json.dumps(entry, ensure_ascii=False))
+                         for i, entry in enumerate(appended_entries(conversation, key, count))]
+                    )
+                self.db.execute(
+                    'INSERT OR REPLACE INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?)',
+                    (session_id, data, time.time())
+                )
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+    
+    def delete(self, session_id):
+        with self._lock:
+            self.db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            self.db.execute('DELETE FROM session_log WHERE session_id = ?', (session_id,))
+            self.db.execute('DELETE FROM leases WHERE session_id = ?', (session_id,))
+            self.db.execute('DELETE FROM controls WHERE session_id = ?', (session_id,))
+    
+    def expire(self, older_than):
+        """刪除在 older_than 之前就沒有更新、且沒有 worker 持有租約的會話"""
+        with self._lock:
+            expired = self.db.execute(
+                'SELECT session_id FROM sessions WHERE updated_at < ? AND session_id NOT IN '
+                '(SELECT session_id FROM leases WHERE expires_at > ?)',
+                (older_than, time.time())
+            ).fetchall()
+            self.db.executemany('DELETE FROM sessions WHERE session_id = ?', expired)
+            self.db.executemany('DELETE FROM session_log WHERE session_id = ?', expired)
+            self.db.execute(
+                'DELETE FROM controls WHERE updated_at < ? AND session_id NOT IN (SELECT session_id FROM sessions)',
+                (older_than,)
+            )
+    
+    def acquire_lease(self, session_id, owner, ttl):
+        """租約不存在、已過期或本來就屬於自己時才能取得"""
+        now = time.time()
+        with self._lock:
+            cursor = self.db.execute(
+                'INSERT INTO leases (session_id, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(session_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.expires_at < ? OR leases.owner = excluded.owner',
+                (session_id, owner, now + ttl, now)
+            )
+        return cursor.rowcount == 1
+    
+    def renew_lease(self, session_id, owner, ttl):
+        with self._lock:
+            cursor = self.db.execute(
+                'UPDATE leases SET expires_at = ? WHERE session_id = ? AND owner = ?',
+                (time.time() + ttl, session_id, owner)
+            )
+        return cursor.rowcount == 1
+    
+    def release_lease(self, session_id, owner):
+        with self._lock:
+            self.db.execute('DELETE FROM leases WHERE session_id = ? AND owner = ?', (session_id, owner))
+    
+    def is_leased(self, session_id):
+        with self._lock:
+            row = self.db.execute(
+                'SELECT 1 FROM leases WHERE session_id = ? AND expires_at > ?', (session_id, time.time())
+            ).fetchone()
+        return row is not None
+    
+    def get_control(self, session_id):
+        with self._lock:
+            row = self.db.execute('SELECT data FROM controls WHERE session_id = ?', (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set_control(self, session_id, **fields):
+        """以 json_patch 在同一個陳述式內合併欄位，多個 worker 同時寫入也不會互相覆蓋；值為 None 的欄位會被移除"""
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO controls (session_id, data, updated_at) VALUES (:session_id, json_patch('{}', :patch), :now) "
+                'ON CONFLICT(session_id) DO UPDATE SET data = json_patch(controls.data, :patch), updated_at = :now',
+                {'session_id': session_id, 'patch': json.dumps(fields), 'now': time.time()}
+            )
+    
+    def clear_control(self, session_id):
+        with self._lock:
+            self.db.execute('DELETE FROM controls WHERE session_id = ?', (session_id,))
+
+class RedisSessionStore:
+    """以 Redis（或相容伺服器）共用會話狀態與租約，適合跨容器、跨節點部署"""
+    shared = True
+    
+    # 只有租約持有者才能續約或釋放
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+    
+    def __init__(self, url):
+        import redis # 選用相依套件，只有設定 redis:// 時才需要
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._renew = self.client.register_script(self.RENEW_SCRIPT)
+        self._release = self.client.register_script(self.RELEASE_SCRIPT)
+    
+    @staticmethod
+    def _log_key(session_id, generation, key):
+        """訊息與時間軸的串列鍵；以會話建立時間區分同一個 ID 重新開始後的會話"""
+        return f'conversation:{session_id}:{generation:.6f}:{key}'
+    
+    def load(self, session_id):
+        data = self.client.get(f'conversation:{session_id}')
+        if not data:
+            return None
+        data = json.loads(data)
+        pipe = self.client.pipeline()
+        for key in APPEND_ONLY_KEYS:
+            pipe.lrange(self._log_key(session_id, data.get('created_at', 0), key), 0, -1)
+        for key, entries in zip(APPEND_ONLY_KEYS, pipe.execute()):
+            data[key] = data.get(key, []) + [json.loads(entry) for entry in entries] # 舊版整份存放的會話本身就帶有訊息
+        return conversation_from_dict(data)
+    
+    def save(self, session_id, conversation):
+        """會話鍵只存較小的欄位，訊息與時間軸以 RPUSH 附加新增的項目，每次寫入量不隨對話長度增長"""
+        generation = conversation.get('created_at', 0)
+        log_keys = {key: self._log_key(session_id, generation, key) for key in APPEND_ONLY_KEYS}
+        pipe = self.client.pipeline()
+        for log_key in log_keys.values():
+            pipe.llen(log_key)
+        stored = dict(zip(APPEND_ONLY_KEYS, pipe.execute()))
+        
+        pipe = self.client.pipeline()
+        if not any(stored.values()):
+            # 同一個 ID 重新開始：移除前一個會話留下的串列
+            previous = self.client.get(f'conversation:{session_id}')
+            previous_generation = json.loads(previous).get('created_at', 0) if previous else generation
+            if previous_generation != generation:
+                pipe.delete(*(self._log_key(session_id, previous_generation, key) for key in APPEND_ONLY_KEYS))
+        for key, log_key in log_keys.items():
+            entries = appended_entries(conversation, key, stored[key])
+            if entries:
+                pipe.rpush(log_key, *(json.dumps(entry, ensure_ascii=False) for entry in entries))
+        # 每次寫入都重設存活時間，閒置超過 SESSION_IDLE_TTL_SECONDS 的會話由 Redis 自動移除
+        ttl = int(SESSION_IDLE_TTL_SECONDS) if SESSION_IDLE_TTL_SECONDS > 0 else None
+        pipe.set(f'conversation:{session_id}', json.dumps(conversation_meta(conversation), ensure_ascii=False), ex=ttl)
+        if ttl:
+            for log_key in log_keys.values():
+                pipe.expire(log_key, ttl)
+        pipe.execute()
+    
+    def delete(self, session_id):
+        keys = [f'conversation:{session_id}', f'lease:{session_id}', f'control:{session_id}']
+        data = self.client.get(f'conversation:{session_id}')
+        if data:
+            generation = json.loads(data).get('created_at', 0)
+            keys += [self._log_key(session_id, generation, key) for key in APPEND_ONLY_KEYS]
+        self.client.delete(*keys)
+    
+    def expire(self, older_than):
+        """由 Redis 的鍵存活時間處理"""
+        pass
+    
+    def acquire_lease(self, session_id, owner, ttl):
+        if self.client.set(f'lease:{session_id}', owner, nx=True, px=int(ttl * 1000)):
+            return True
+        return self.renew_lease(session_id, owner, ttl)
+    
+    def renew_lease(self, session_id, owner, ttl):
+        return bool(self._renew(keys=[f'lease:{session_id}'], args=[owner, int(ttl * 1000)]))
+    
+    def release_lease(self, session_id, owner):
+        self._release(keys=[f'lease:{session_id}'], args=[owner])
+    
+    def is_leased(self, session_id):
+        return bool(self.client.exists(f'lease:{session_id}'))
+    
+    def get_control(self, session_id):
+        fields = self.client.hgetall(f'control:{session_id}')
+        return {key: json.loads(value) for key, value in fields.items()} if fields else None
+    
+    def set_control(self, session_id, **fields):
+        """控制紀錄存成雜湊，各欄位獨立寫入；值為 None 的欄位會被移除"""
+        key = f'control:{session_id}'
+        pipe = self.client.pipeline()
+        values = {name: json.dumps(value) for name, value in fields.items() if value is not None}
+        removed = [name for name, value in fields.items() if value is None]
+        if values:
+            pipe.hset(key, mapping=values)
+        if removed:
+            pipe.hdel(key, *removed)
+        if SESSION_IDLE_TTL_SECONDS > 0:
+            pipe.expire(key, int(SESSION_IDLE_TTL_SECONDS))
+        pipe.execute()
+    
+    def clear_control(self, session_id):
+        self.client.delete(f'control:{session_id}')
+
+def create_session_store(url):
+    """依 SESSION_STORE_URL 建立會話儲存後端"""
+    if not url:
+        return MemorySessionStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteSessionStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSessionStore(url)
+    raise ValueError(f"不支援的 SESSION_STORE_URL：{url}")
+
+class TranscriptStore:
+    """
+    對話逐字稿的持久儲存（SQLite，WAL 模式）：每則訊息一列、只新增不修改，會話設定與狀態另存一列。
+    寫入先依序放進記憶體佇列，由背景執行緒每 flush_seconds 秒或累積 batch_size 筆時以單一交易寫入，
+    讀取前會先寫出佇列中的內容。
+    """
+    # 會話列不保存的欄位：訊息另存、conversation_history 是檢視，斷線與暫停標記重新載入後沒有意義
+    TRANSIENT_KEYS = ('messages', 'conversation_history', 'detached_at', 'paused')
+    
+    def __init__(self, path, flush_seconds=TRANSCRIPT_FLUSH_SECONDS, batch_size=TRANSCRIPT_BATCH_SIZE):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 只在檢查點時 fsync：程序當機不會遺失已提交的交易
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS conversations (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+            'status TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, type TEXT NOT NULL, '
+            'role TEXT, content TEXT NOT NULL, round INTEGER, is_role1 INTEGER, PRIMARY KEY (session_id, seq)) WITHOUT ROWID'
+        )
+        self.db.commit()
+        self.pending = [] # (sql, params)，依呼叫順序寫入
+        self.written = 0
+        self._lock = Lock() # 保護 pending
+        self._write_lock = Lock() # 保護 db，寫入期間不擋住新的附加
+        self._wakeup = Event()
+        Thread(target=self._run, name='transcript-writer', daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _enqueue(self, *ops):
+        with self._lock:
+            self.pending.extend(ops)
+            if len(self.pending) >= self.batch_size:
+                self._wakeup.set()
+    
+    @staticmethod
+    def _message_op(session_id, message):
+        return (
+            'INSERT OR IGNORE INTO messages (session_id, seq, type, role, content, round, is_role1) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (session_id, message.seq, message.type, message.role, message.content, message.round,
+             None if message.is_role1 is None else int(message.is_role1))
+        )
+    
+    def _conversation_op(self, session_id, conversation):
+        data = {key: value for key, value in conversation.items() if key not in self.TRANSIENT_KEYS}
+        return (
+            'INSERT INTO conversations (session_id, data, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, status = excluded.status, updated_at = excluded.updated_at',
+            (session_id, json.dumps(data, ensure_ascii=False), conversation.get('status', ''),
+             conversation.get('created_at', time.time()), time.time())
+        )
+    
+    def start_conversation(self, session_id, conversation):
+        """記錄新會話；同一個 ID 重新開始時取代舊的逐字稿。分支會話的共用前綴在這裡一併寫入"""
+        self._enqueue(
+            ('DELETE FROM messages WHERE session_id = ?', (session_id,)),
+            self._conversation_op(session_id, conversation),
+            *(self._message_op(session_id, message) for message in conversation['messages'])
+        )
+    
+    def save_conversation(self, session_id, conversation):
+        """更新會話設定與狀態（故事大綱產生後、會話結束時）"""
+        self._enqueue(self._conversation_op(session_id, conversation))
+    
+    def append_message(self, session_id, message):
+        self._enqueue(self._message_op(session_id, message))
+    
+    def flush(self):
+        """把佇列中的寫入以單一交易寫出；失敗時放回佇列前端，下次再試"""
+        with self._write_lock:
+            with self._lock:
+                ops, self.pending = self.pending, []
+            if not ops:
+                return
+            started_at = time.perf_counter()
+            try:
+                with self.db:
+                    for sql, params in ops:
+                        self.db.execute(sql, params)
+            except sqlite3.Error as e:
+                logger.error(f"寫入逐字稿失敗，稍後重試: {e}")
+                with self._lock:
+                    self.pending[:0] = ops
+                return
+            self.written += len(ops)
+            metrics.observe('transcript_flush_seconds', time.perf_counter() - started_at)
+            metrics.inc('transcript_writes_total', len(ops))
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"逐字稿寫入執行緒錯誤: {e}")
+    
+    def load_meta(self, session_id):
+        """只讀取會話設定與狀態（不含訊息）"""
+        self.flush()
+        with self._write_lock:
+            row = self.db.execute('SELECT data FROM conversations WHERE session_id = ?', (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def load(self, session_id):
+        """讀回完整會話（含訊息）；不存在時回傳 None"""
+        data = self.load_meta(session_id)
+        if data is None:
+            return None
+        data['messages'] = list(self.iter_messages(session_id))
+        return conversation_from_dict(data)
+    
+    def iter_messages(self, session_id, batch=200):
+        """依序號逐批讀出訊息（dict），以獨立的唯讀連線進行，不必把整份逐字稿載入記憶體"""
+        self.flush()
+        reader = sqlite3.connect(self.path, timeout=30)
+        try:
+            cursor = reader.execute(
+                'SELECT seq, type, role, content, round, is_role1 FROM messages WHERE session_id = ? ORDER BY seq',
+                (session_id,)
+            )
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    return
+                for seq, msg_type, role, content, round_num, is_role1 in rows:
+                    if msg_type == 'dialogue':
+                        yield {'seq': seq, 'type': msg_type, 'role': role, 'content': content, 'round': round_num, 'is_role1': bool(is_role1)}
+                    else:
+                        yield {'seq': seq, 'type': msg_type, 'content': content, 'round': round_num}
+        finally:
+            reader.close()
+    
+    def stats(self):
+        with self._lock:
+            pending = len(self.pending)
+        return {'path': self.path, 'pending_writes': pending, 'writes': self.written}
+
+class ResponseCache:
+    """
+    以提示詞內容雜湊為鍵的模型回應快取：記憶體 LRU（含 TTL）＋可選的 SQLite 持久層。
+    SQLite 層會做磁碟 I/O，由 _call_model 放到執行緒中呼叫（load / persist），不在事件迴圈上執行。
+    """
+    
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, ttl_seconds=LLM_CACHE_TTL_SECONDS, db_path=LLM_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict() # key -> (value, expires_at)
+        self.counters = {}
+        self._lock = Lock()
+        self._db_lock = Lock()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)')
+            self.db.commit()
     
-    def create_conversation(self, session_id, role1, role2, role1_description, role2_description, topic, word_limit, rounds, narrator_mode):
-        """創建新的對話會話，新增 narrator_mode 參數"""
+    @staticmethod
+    def make_key(prompt, model_name, generation_config=None):
+        """正規化空白後，以模型名稱、生成設定與提示詞計算 SHA-256 作為快取鍵"""
+        normalized = ' '.join(prompt.split())
+        payload = json.dumps([model_name, generation_config, normalized], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _count(self, call_type, field):
+        counter = self.counters.setdefault(call_type, {'hits': 0, 'disk_hits': 0, 'misses': 0})
+        counter[field] += 1
+    
+    def get(self, key, call_type):
+        """查詢記憶體層；未命中且沒有 SQLite 層時記為未命中，有 SQLite 層時交給 load 決定"""
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self._count(call_type, 'hits')
+                    return entry[0]
+                del self.entries[key]
+            if self.db is None:
+                self._count(call_type, 'misses')
+            return None
+    
+    def load(self, key, call_type):
+        """查詢 SQLite 層（阻塞，須在執行緒中呼叫）；命中的項目會提升回記憶體"""
+        now = time.time()
+        with self._db_lock:
+            row = self.db.execute(
+                'SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self._count(call_type, 'misses')
+                return None
+            self._store(key, row[0], row[1])
+            self._count(call_type, 'disk_hits')
+            return row[0]
+    
+    def set(self, key, value):
+        """寫入記憶體層，回傳到期時間供 persist 寫入 SQLite 層"""
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._store(key, value, expires_at)
+        return expires_at
+    
+    def persist(self, key, value, expires_at):
+        """寫入 SQLite 層並刪除已過期的列（阻塞，須在執行緒中呼叫）"""
+        with self._db_lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, expires_at)
+            )
+            self.db.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+            self.db.commit()
+    
+    def _store(self, key, value, expires_at):
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def stats(self):
+        """回傳各呼叫類型的命中／未命中次數與目前的記憶體項目數"""
+        with self._lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'persistent': self.db is not None,
+                'by_call_type': {call_type: dict(counter) for call_type, counter in self.counters.items()}
+            }
+
+# 模型呼叫限流：整個部署（API 金鑰）的每分鐘請求數與每分鐘權杖數（0 表示不限制），以及可重試錯誤的退避設定。
+# 權杖桶在各 worker 程序內各自計算，因此依 WEB_CONCURRENCY 平均分配，所有 worker 合計不超過設定值
+WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+MODEL_RPM_LIMIT = int(os.getenv('MODEL_RPM_LIMIT', 0))
+MODEL_TPM_LIMIT = int(os.getenv('MODEL_TPM_LIMIT', 0))
+
+def per_worker_limit(limit):
+    """每個 worker 分到的限額；有設定上限時至少為 1，避免 0 被當成不限制"""
+    return max(1, limit // WEB_CONCURRENCY) if limit > 0 else 0
+MODEL_MAX_RETRIES = int(os.getenv('MODEL_MAX_RETRIES', 4))
+MODEL_RETRY_BASE_SECONDS = float(os.getenv('MODEL_RETRY_BASE_SECONDS', 1))
+MODEL_RETRY_MAX_SECONDS = float(os.getenv('MODEL_RETRY_MAX_SECONDS', 30))
+
+# 可重試的錯誤：配額用盡（429）、服務暫時無法使用、逾時等；以類別名稱判斷，不必直接依賴 SDK 的例外模組
+RETRYABLE_ERRORS = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+    'DeadlineExceeded', 'GatewayTimeout', 'ConnectionError', 'TimeoutError'
+}
+
+def is_retryable_error(error):
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+def approx_tokens(text):
+    """粗估文字的權杖數：中文約兩字一個權杖（目前的 SDK 回應不含用量資訊）"""
+    return len(text) // 2
+
+def output_token_cap(max_chars):
+    """依字數上限換算 max_output_tokens：中文每字最多約一個半權杖，另留收尾的餘裕，避免句子被截斷"""
+    return int(max_chars * 1.5) + 64
+
+def is_thinking_model(model_name):
+    return 'thinking' in model_name or 'gemini-2.5' in model_name
+
+def estimate_tokens(prompt):
+    """粗估一次呼叫消耗的權杖數（另預留輸出額度），用於 TPM 限流"""
+    return approx_tokens(prompt) + 512
+
+class TokenBucket:
+    """每分鐘補滿 rate 個權杖的權杖桶；rate 為 0 時不限制"""
+    
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute
+        self.tokens = float(rate_per_minute)
+        self.updated_at = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate / 60)
+        self.updated_at = now
+    
+    def delay(self, amount):
+        """還要等幾秒才有足夠權杖；單次需求超過桶容量時以桶容量計算，避免永遠等不到"""
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        amount = min(amount, self.rate)
+        return max(0, (amount - self.tokens) * 60 / self.rate)
+    
+    def consume(self, amount):
+        if self.rate > 0:
+            self._refill()
+            self.tokens -= min(amount, self.rate)
+
+class ModelCallScheduler:
+    """
+    所有模型呼叫的共用排程器（准入佇列）。
+    以 RPM / TPM 權杖桶限流、限制同時進行中的呼叫數，並在各會話之間輪流放行，避免單一會話佔滿配額；
+    排隊時透過 on_queue_position 通知該會話目前前方還有幾個會話。
+    """
+    
+    def __init__(self, max_concurrent=MAX_INFLIGHT_MODEL_CALLS, rpm=per_worker_limit(MODEL_RPM_LIMIT), tpm=per_worker_limit(MODEL_TPM_LIMIT)):
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.queues = OrderedDict() # session_id -> deque[(waiter, tokens)]，依輪替順序排列
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.on_queue_position = None
+        self._positions = {}
+        self._timer = None
+    
+    async def acquire(self, session_id, tokens):
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(session_id, deque()).append((waiter, tokens))
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.done() or waiter.cancelled():
+                self._remove(session_id, waiter)
+            else:
+                self.release()
+            raise
+    
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+    
+    def _remove(self, session_id, waiter):
+        queue = self.queues.get(session_id)
+        if queue is None:
+            return
+        for item in list(queue):
+            if item[0] is waiter:
+                queue.remove(item)
+        if not queue:
+            del self.queues[session_id]
+        self._dispatch()
+    
+    def _dispatch(self):
+        """依輪替順序放行排在最前面的會話；權杖不足時排定計時器稍後再試"""
+        while self.queues and self.in_flight < self.max_concurrent:
+            session_id, queue = next(iter(self.queues.items()))
+            waiter, tokens = queue[0]
+            wait = max(self.request_bucket.delay(1), self.token_bucket.delay(tokens))
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+                break
+            
+            queue.popleft()
+            # 放行後把該會話移到隊尾，讓其他會話輪流使用
+            del self.queues[session_id]
+            if queue:
+                self.queues[session_id] = queue
+            if waiter.cancelled():
+                continue
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(tokens)
+            self.in_flight += 1
+            waiter.set_result(None)
+        self._notify_positions()
+    
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+    
+    def _notify_positions(self):
+        """排隊位置有變化時才通知，0 表示已輪到該會話"""
+        positions = {session_id: index + 1 for index, session_id in enumerate(self.queues)}
+        for session_id in set(self._positions) | set(positions):
+            position = positions.get(session_id, 0)
+            if self._positions.get(session_id, 0) != position and self.on_queue_position is not None:
+                self.on_queue_position(session_id, position)
+        self._positions = positions
+    
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'queued_calls': sum(len(queue) for queue in self.queues.values()),
+            'queued_sessions': len(self.queues),
+            'max_concurrent': self.max_concurrent
+        }
+
+# 延遲直方圖的分界（秒）
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class MetricsRegistry:
+    """
+    以 Prometheus 文字格式輸出的最小指標集合：計數器、量表與直方圖。
+    量表也可以登記成函數，輸出時才取值（例如排程器目前的狀態）。
+    指標只反映本程序；多 worker 部署時每個 worker 各自提供 /metrics。
+    """
+    
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.meta = OrderedDict() # name -> (type, help)
+        self.values = {} # (name, labels) -> 數值（計數器與量表）
+        self.histograms = {} # (name, labels) -> [各區間次數..., 總和, 次數]
+        self.callbacks = {} # name -> 回傳 {labels: 數值} 的函數
+        self._lock = Lock()
+    
+    def describe(self, name, kind, help_text):
+        self.meta[name] = (kind, help_text)
+    
+    def register_gauge(self, name, help_text, func):
+        """登記一個輸出時才計算的量表；func 回傳數值，或以標籤 tuple 為鍵的 dict"""
+        self.describe(name, 'gauge', help_text)
+        self.callbacks[name] = func
+    
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+    
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        pairs = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return '{' + ','.join(pairs) + '}'
+    
+    def render(self):
+        """輸出 Prometheus 文字格式（text/plain; version=0.0.4）"""
+        with self._lock:
+            values = dict(self.values)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        for name, func in self.callbacks.items():
+            try:
+                result = func()
+            except Exception as e:
+                logger.warning(f"讀取指標 {name} 失敗: {e}")
+                continue
+            if not isinstance(result, dict):
+                result = {(): result}
+            for labels, value in result.items():
+                values[(name, labels)] = value
+        
+        lines = []
+        for name, (kind, help_text) in self.meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind != 'histogram':
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f'{name}{self._format_labels(labels)} {value}')
+                continue
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{self._format_labels(labels + (("le", "+Inf"),))} {histogram[-1]}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {histogram[-2]}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('model_call_seconds', 'histogram', '單次模型呼叫（含串流）的耗時，依呼叫類型')
+metrics.describe('model_queue_wait_seconds', 'histogram', '模型呼叫在准入佇列中等待的時間，依呼叫類型')
+metrics.describe('session_queue_wait_seconds', 'histogram', '會話等待排程器空位的時間')
+metrics.describe('conversation_turn_seconds', 'histogram', '一則訊息從開始生成到送出的耗時，依訊息類型')
+metrics.describe('conversation_sleep_seconds', 'histogram', '刻意等待的時間：呈現間隔、重試退避或暫停')
+metrics.describe('model_calls_total', 'counter', '模型呼叫次數，依呼叫類型與結果（ok / cached / error / cancelled）')
+metrics.describe('model_prompt_tokens_total', 'counter', '輸入權杖數（估計值），依呼叫類型')
+metrics.describe('model_output_tokens_total', 'counter', '輸出權杖數（估計值），依呼叫類型')
+metrics.describe('model_errors_total', 'counter', '模型呼叫失敗次數（每次嘗試），依呼叫類型與錯誤類別')
+metrics.describe('model_retries_total', 'counter', '模型呼叫重試次數，依呼叫類型與錯誤類別')
+metrics.describe('conversations_total', 'counter', '結束的會話數，依結果（finished / error / cancelled）')
+metrics.describe('transcript_flush_seconds', 'histogram', '逐字稿每次批次寫入（單一交易）的耗時')
+metrics.describe('transcript_writes_total', 'counter', '寫入逐字稿儲存的列操作數')
+metrics.describe('connected_sockets', 'gauge', '目前連線中的 Socket.IO 客戶端數')
+metrics.inc('connected_sockets', 0)
+
+# 假模型設定：延遲分佈（fixed:秒、uniform:最小,最大、normal:平均,標準差、lognormal:中位數,sigma）、
+# 串流每段字數與段間延遲、錯誤注入比例，以及回應字數
+FAKE_MODEL_LATENCY = os.getenv('FAKE_MODEL_LATENCY', 'lognormal:0.8,0.4')
+FAKE_MODEL_CHUNK_CHARS = int(os.getenv('FAKE_MODEL_CHUNK_CHARS', 8))
+FAKE_MODEL_CHUNK_DELAY = float(os.getenv('FAKE_MODEL_CHUNK_DELAY', 0.05))
+FAKE_MODEL_ERROR_RATE = float(os.getenv('FAKE_MODEL_ERROR_RATE', 0))
+FAKE_MODEL_OUTPUT_CHARS = int(os.getenv('FAKE_MODEL_OUTPUT_CHARS', 60))
+
+def eventlet_patched():
+    """是否在 eventlet monkey patch 過的程序中執行（部署用的 gunicorn eventlet worker）"""
+    eventlet = sys.modules.get('eventlet')
+    return eventlet is not None and eventlet.patcher.is_monkey_patched('thread')
+
+if eventlet_patched():
+    from eventlet import tpool
+    # 模型呼叫在 tpool 的 OS 執行緒中進行，執行緒數至少要容納同時呼叫上限
+    tpool.set_num_threads(max(int(os.getenv('EVENTLET_THREADPOOL_SIZE', 20)), MAX_INFLIGHT_MODEL_CALLS))
+    unpatched_time = sys.modules['eventlet'].patcher.original('time')
+else:
+    tpool = None
+    unpatched_time = time
+
+def run_blocking(func, *args, **kwargs):
+    """
+    執行會阻塞在 C 擴充模組中的呼叫（模型 SDK 的 gRPC 請求）。eventlet worker 中的執行緒都是綠色執行緒，
+    這類呼叫不會讓出控制權，會卡住整個 worker 的所有請求；因此改在 eventlet.tpool 的 OS 執行緒中執行，
+    呼叫端等待期間照常讓出。沒有 monkey patch 時（python app.py、batch.py、測試）直接呼叫。
+    """
+    if tpool is not None:
+        return tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+class ConversationCancelled(Exception):
+    """會話已取消：模型呼叫的執行緒在串流途中檢查到取消權杖時拋出，停止接收剩下的輸出"""
+
+class ResourceExhausted(Exception):
+    """假模型注入的配額錯誤；類別名稱與 SDK 的 429 例外相同，會走一樣的重試流程"""
+
+class FakeChunk:
+    """模擬 SDK 回應（或串流片段）的 text 屬性"""
+    __slots__ = ('text',)
+    
+    def __init__(self, text):
+        self.text = text
+
+class FakeModelBackend:
+    """
+    離線假模型：介面與 genai.GenerativeModel 的 generate_content 相同，可設定延遲分佈、串流分段與錯誤注入。
+    延遲一律以未被 monkey patch 的 time.sleep 等待，與 SDK 在 C 擴充模組中阻塞的行為相同。
+    """
+    
+    def __init__(self, model_name='fake-model', latency=FAKE_MODEL_LATENCY, chunk_chars=FAKE_MODEL_CHUNK_CHARS,
+                 chunk_delay=FAKE_MODEL_CHUNK_DELAY, error_rate=FAKE_MODEL_ERROR_RATE, output_chars=FAKE_MODEL_OUTPUT_CHARS):
+        self.model_name = model_name
+        self.latency = self.parse_latency(latency)
+        self.chunk_chars = max(1, chunk_chars)
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.output_chars = output_chars
+    
+    @staticmethod
+    def parse_latency(spec):
+        """把延遲分佈設定轉成取樣函數，例如 'uniform:0.5,1.5'"""
+        kind, _, params = spec.partition(':')
+        values = [float(v) for v in params.split(',') if v.strip()]
+        if kind == 'fixed':
+            return lambda: values[0]
+        if kind == 'uniform':
+            return lambda: random.uniform(values[0], values[1])
+        if kind == 'normal':
+            return lambda: max(0.0, random.gauss(values[0], values[1]))
+        if kind == 'lognormal':
+            return lambda: random.lognormvariate(math.log(values[0]), values[1])
+        raise ValueError(f"不支援的延遲分佈：{spec}")
+    
+    def reply_for(self, prompt):
+        """依提示詞產生固定的回應內容，同一提示詞每次結果相同"""
+        digest = hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:8]
+        text = f"（離線測試回應 {digest}）"
+        while len(text) < self.output_chars:
+            text += "這是一段由假模型產生的內容，用來量測系統本身的延遲與吞吐量。"
+        return text[:self.output_chars]
+    
+    def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+        unpatched_time.sleep(self.latency())
+        if self.error_rate and random.random() < self.error_rate:
+            raise ResourceExhausted('429 假模型注入的配額錯誤')
+        text = self.reply_for(prompt)
+        if generation_config and generation_config.get('max_output_tokens'):
+            text = text[:generation_config['max_output_tokens']]
+        if not stream:
+            return FakeChunk(text)
+        return self._stream(text)
+    
+    def _stream(self, text):
+        for start in range(0, len(text), self.chunk_chars):
+            if start:
+                unpatched_time.sleep(self.chunk_delay)
+            yield FakeChunk(text[start:start + self.chunk_chars])
+
+def create_model_backend(model_name):
+    """依 MODEL_BACKEND 建立模型後端"""
+    if MODEL_BACKEND == 'fake':
+        return FakeModelBackend(model_name)
+    if MODEL_BACKEND == 'gemini':
+        return load_genai().GenerativeModel(model_name)
+    raise ValueError(f"不支援的 MODEL_BACKEND：{MODEL_BACKEND}")
+
+class ConversationManager:
+    def __init__(self, max_model_calls=MAX_INFLIGHT_MODEL_CALLS, store=None, transcripts=None):
+        self.store = store or create_session_store(SESSION_STORE_URL)
+        # 逐字稿持久儲存（可選）：啟用時結束的會話會卸載出記憶體，查詢時再讀回
+        self.transcripts = transcripts or (TranscriptStore(TRANSCRIPT_DB) if TRANSCRIPT_DB else None)
+        # 記憶體後端時工作集就是儲存本身；共用後端時只放本程序正在驅動的會話，其餘從儲存讀取
+        self.conversations = self.store.sessions if not self.store.shared else OrderedDict()
+        self.call_scheduler = ModelCallScheduler(max_model_calls)
+        self.response_cache = ResponseCache()
+        # 依呼叫類型路由到不同模型（見 MODEL_ROUTES），模型物件在第一次使用時建立
+        self.models = {}
+        # 執行中會話的取消權杖（session_id -> threading.Event），由 ConversationScheduler 登記
+        self.cancel_events = {}
+        # 各會話排隊中、呼叫中或退避中的模型呼叫數
+        self.model_calls = {}
+    
+    def create_conversation(self, session_id, role1, role2, role1_description, role2_description, topic, word_limit, rounds, narrator_mode, messages=None, transcript=True, **fields):
+        """
+        創建新的對話會話，新增 narrator_mode 參數；分支會話另外帶入共用前綴的訊息紀錄與沿用的欄位。
+        transcript=False 時不寫入逐字稿儲存（批次劇本的結果另外寫入輸出 JSONL，跑完即刪除）。
+        """
+        if messages is None:
+            messages = MessageLog()
         self.conversations[session_id] = {
             'role1': role1,
             'role2': role2,
@@ -40,15 +1234,390 @@ class ConversationManager:
             'word_limit': word_limit,
             'rounds': rounds,
             'current_round': 0,
-            'messages': [], # 儲存實際對話和旁白訊息
-            'conversation_history': [], # 僅儲存對話訊息，用於生成角色回應
+            'messages': messages, # 儲存實際對話和旁白訊息
+            'conversation_history': messages.history(), # 僅對話訊息的檢視，用於生成角色回應
             'story_outline': None,
-            'narrator_mode': narrator_mode # NEW: 儲存旁白模式設定
+            'history_summary': '', # 已摺疊的較早對話摘要
+            'summarized_count': 0, # conversation_history 中已摺疊進摘要的訊息數
+            'narrator_mode': narrator_mode, # NEW: 儲存旁白模式設定
+            'status': 'pending', # pending / running / finished / error / cancelled
+            'paused': None, # 暫停來源（user / detached / generation_failed），None 表示未暫停
+            'created_at': time.time(),
+            'last_active': time.time(),
+            'timeline': [], # 各階段的開始時間與耗時，供 /api/conversation 檢視延遲來源
+            'transcript': transcript, # 是否寫入逐字稿儲存
+            **fields
         }
+        # 同一個 ID 重新開始時，舊會話留下的停止／暫停要求不能套用到新的會話
+        self.store.clear_control(session_id)
+        if self.transcribed(self.conversations[session_id]):
+            self.transcripts.start_conversation(session_id, self.conversations[session_id])
+        self.evict_idle()
+        self.persist(session_id)
         return True
     
-    async def generate_story_outline(self, session_id):
-        """生成故事大綱"""
+    def fork_conversation(self, source_id, session_id, round_num, **overrides):
+        """
+        從來源會話第 round_num 輪結束處分支出新會話：沿用故事大綱，前 round_num 輪的訊息以 MessageLog.fork 共用而非複製，
+        之後的輪次由 run_conversation_background 從分支點接續生成。overrides 可改寫角色描述、話題、字數、輪數與旁白模式。
+        來源不存在時回傳 None；分支點不合理時拋出 ValueError。
+        """
+        source = self.get_conversation(source_id)
+        if source is None:
+            return None
+        if not source.get('story_outline'):
+            raise ValueError('來源對話尚未產生故事大綱')
+        if round_num < 0 or round_num > len(source['conversation_history']) // 2:
+            raise ValueError('來源對話尚未進行到該輪')
+        
+        settings = {key: source[key] for key in (
+            'role1', 'role2', 'role1_description', 'role2_description', 'topic', 'word_limit', 'rounds', 'narrator_mode'
+        )}
+        settings.update(overrides)
+        if settings['rounds'] <= round_num:
+            raise ValueError('輪數必須大於分支輪數')
+        
+        # 訊息依輪次附加，分支點即第一則超過 round_num 輪的訊息
+        source_messages = source['messages']
+        length = next((i for i, m in enumerate(source_messages) if (m.round or 0) > round_num), len(source_messages))
+        messages = source_messages.fork(length)
+        
+        # 摘要只涵蓋分支點之前的對話時才能沿用，否則由 update_history_summary 重新摺疊
+        kept_summary = source['summarized_count'] <= round_num * 2
+        self.create_conversation(
+            session_id, messages=messages,
+            story_outline=source['story_outline'],
+            history_summary=source['history_summary'] if kept_summary else '',
+            summarized_count=source['summarized_count'] if kept_summary else 0,
+            current_round=round_num,
+            forked_from={'session_id': source_id, 'round': round_num},
+            **settings
+        )
+        return self.conversations[session_id]
+    
+    @property
+    def worker_id(self):
+        """租約持有者識別：主機名稱加程序編號（gunicorn fork 後每個 worker 不同）"""
+        return f"{socket.gethostname()}-{os.getpid()}"
+    
+    def touch(self, session_id):
+        """更新最近使用時間，並移到 LRU 順序的最後"""
+        conversation = self.conversations.get(session_id)
+        if conversation is not None:
+            conversation['last_active'] = time.time()
+            self.conversations.move_to_end(session_id)
+    
+    def persist(self, session_id):
+        """把本程序正在驅動的會話狀態寫回儲存，讓其他 worker 讀得到最新進度"""
+        conversation = self.conversations.get(session_id)
+        if conversation is not None:
+            self.touch(session_id)
+            self.store.save(session_id, conversation)
+    
+    def evict_idle(self):
+        """
+        移除閒置超過 SESSION_IDLE_TTL_SECONDS 的會話，總數超過 MAX_STORED_SESSIONS 時再依 LRU 順序淘汰。
+        執行中、已排入排程器或還有模型呼叫在排隊／進行中的會話一律保留；
+        尚未開始（pending）的會話不參與 LRU 淘汰，只在閒置逾期後移除。
+        """
+        now = time.time()
+        evictable = [
+            session_id for session_id, conversation in list(self.conversations.items())
+            if conversation.get('status') != 'running' and session_id not in self.cancel_events and session_id not in self.model_calls
+        ]
+        expired = [
+            session_id for session_id in evictable
+            if SESSION_IDLE_TTL_SECONDS > 0 and now - self.conversations[session_id]['last_active'] > SESSION_IDLE_TTL_SECONDS
+        ]
+        excess = len(self.conversations) - len(expired) - MAX_STORED_SESSIONS
+        if excess > 0:
+            expired += [
+                session_id for session_id in evictable
+                if session_id not in expired and self.conversations[session_id].get('status') != 'pending'
+            ][:excess]
+        
+        for session_id in expired:
+            self.delete_conversation(session_id)
+        if expired:
+            logger.info(f"已淘汰閒置對話 {len(expired)} 筆")
+        if SESSION_IDLE_TTL_SECONDS > 0:
+            self.store.expire(now - SESSION_IDLE_TTL_SECONDS)
+    
+    def memory_stats(self):
+        """本程序工作集的會話數、訊息數、訊息內容佔用位元組與 RSS"""
+        conversations = list(self.conversations.values())
+        return {
+            'sessions': len(conversations),
+            'running_sessions': sum(1 for c in conversations if c.get('status') == 'running'),
+            'max_sessions': MAX_STORED_SESSIONS,
+            'messages': sum(len(c['messages']) for c in conversations),
+            'message_content_bytes': sum(sys.getsizeof(m.content) for c in conversations for m in c['messages']),
+            'rss_bytes': current_rss_bytes(),
+            'transcripts': self.transcripts.stats() if self.transcripts is not None else None
+        }
+    
+    def claim(self, session_id):
+        """取得驅動會話的租約，並把會話載入本程序的工作集；已有其他 worker 持有時回傳 False"""
+        if not self.store.acquire_lease(session_id, self.worker_id, SESSION_LEASE_SECONDS):
+            return False
+        if session_id not in self.conversations:
+            conversation = self.store.load(session_id)
+            if conversation is None:
+                self.store.release_lease(session_id, self.worker_id)
+                return False
+            self.conversations[session_id] = conversation
+        return True
+    
+    def renew_lease(self, session_id):
+        return self.store.renew_lease(session_id, self.worker_id, SESSION_LEASE_SECONDS)
+    
+    def transcribed(self, conversation):
+        """會話是否寫入逐字稿儲存"""
+        return self.transcripts is not None and conversation.get('transcript', True)
+    
+    def save_transcript(self, session_id):
+        """把會話設定與狀態寫入逐字稿儲存（訊息由 add_message 個別附加）"""
+        conversation = self.conversations.get(session_id)
+        if conversation is not None and self.transcribed(conversation):
+            self.transcripts.save_conversation(session_id, conversation)
+    
+    def offload(self, session_id, conversation):
+        """
+        會話結束後寫入最終狀態並移出記憶體，之後由 get_conversation 從逐字稿儲存讀回。
+        共用後端時先寫出逐字稿再刪除共用儲存中的會話（連同租約），其他 worker 才會改讀逐字稿，而不是停在 running 的舊狀態。
+        同一個 ID 已經重新開始時（工作集裡是新的會話）不做任何事。
+        """
+        if not self.transcribed(conversation) or conversation.get('status') not in ('finished', 'error', 'cancelled'):
+            return
+        if self.conversations.get(session_id) is not conversation:
+            return
+        self.transcripts.save_conversation(session_id, conversation)
+        if self.store.shared:
+            self.transcripts.flush()
+            self.store.delete(session_id)
+        self.conversations.pop(session_id, None)
+    
+    def release(self, session_id):
+        """釋放租約；共用後端時同時把會話移出本程序的工作集"""
+        self.persist(session_id)
+        self.store.release_lease(session_id, self.worker_id)
+        if self.store.shared:
+            self.conversations.pop(session_id, None)
+    
+    def record_timeline(self, session_id, stage, started_at, round_num=None, **fields):
+        """在會話時間軸記下一個階段：相對於會話建立的開始秒數、耗時，以及排隊／模型時間等細節"""
+        conversation = self.conversations.get(session_id)
+        if conversation is None:
+            return
+        now = time.time()
+        event = {
+            'stage': stage,
+            'round': conversation['current_round'] if round_num is None else round_num,
+            'start': round(started_at - conversation.get('created_at', started_at), 3),
+            'duration': round(now - started_at, 3)
+        }
+        event.update({key: round(value, 3) if isinstance(value, float) else value for key, value in fields.items()})
+        conversation.setdefault('timeline', []).append(event)
+    
+    def detach(self, session_id):
+        """
+        客戶端斷線時標記會話並回傳標記時間；寬限期內重新加入會清除標記（已卸載的會話不必處理）。
+        標記寫在控制紀錄而不是會話狀態，其他 worker 驅動會話時寫回的進度不會把它蓋掉。
+        """
+        if self.get_conversation(session_id, load_transcript=False) is None:
+            return None
+        detached_at = time.time()
+        self.store.set_control(session_id, detached_at=detached_at)
+        return detached_at
+    
+    def reattach(self, session_id):
+        self.store.set_control(session_id, detached_at=None)
+    
+    def detached_at(self, session_id):
+        return (self.store.get_control(session_id) or {}).get('detached_at')
+    
+    def delete_conversation(self, session_id):
+        """刪除會話（本機工作集與共用儲存）"""
+        self.conversations.pop(session_id, None)
+        self.store.delete(session_id)
+    
+    @staticmethod
+    def model_name_for(call_type):
+        """該呼叫類型使用的模型名稱"""
+        return MODEL_ROUTES.get(call_type, MODEL_NAME)
+    
+    def get_model(self, model_name):
+        """取得模型物件，第一次使用時才建立（可能需要匯入 SDK，應在工作執行緒中呼叫）"""
+        model = self.models.get(model_name)
+        if model is None:
+            model = self.models[model_name] = create_model_backend(model_name)
+        return model
+    
+    def model_for(self, call_type):
+        """依呼叫類型（outline / dialogue / narrator / summary）路由到的模型物件，同一個模型的呼叫類型共用同一個物件"""
+        return self.get_model(self.model_name_for(call_type))
+    
+    @staticmethod
+    def generation_config(call_type, model_name, max_chars=None):
+        """
+        每次呼叫的生成設定：依字數上限換算 max_output_tokens（思考模型另加思考預算），
+        以及 MODEL_TEMPERATURES 指定的 temperature；沒有任何設定時回傳 None
+        """
+        config = {}
+        if call_type in MODEL_TEMPERATURES:
+            config['temperature'] = MODEL_TEMPERATURES[call_type]
+        max_chars = max_chars or CALL_TYPE_MAX_CHARS.get(call_type)
+        if max_chars:
+            config['max_output_tokens'] = output_token_cap(max_chars)
+            if is_thinking_model(model_name):
+                config['max_output_tokens'] += MODEL_THINKING_BUDGET
+        return config or None
+    
+    def _generate_text(self, call_type, prompt, on_chunk=None, generation_config=None, cancelled=None):
+        """
+        呼叫模型並回傳完整文字；提供 on_chunk 時改用串流 API，每收到一段就回呼一次。
+        cancelled 是會話的取消權杖：開始前與每收到一段時檢查，已取消就中止（非串流呼叫只能等它完成）。
+        """
+        if cancelled is not None and cancelled.is_set():
+            raise ConversationCancelled()
+        model = self.model_for(call_type)
+        if on_chunk is None:
+            response = run_blocking(model.generate_content, prompt, generation_config=generation_config)
+            return response.text.strip()
+        
+        # 串流的每一段都可能阻塞，逐段交給 run_blocking；回呼（送出 Socket.IO 事件）留在呼叫端的執行緒
+        parts = []
+        response = iter(run_blocking(model.generate_content, prompt, stream=True, generation_config=generation_config))
+        while True:
+            chunk = run_blocking(next, response, None)
+            if chunk is None:
+                break
+            if cancelled is not None and cancelled.is_set():
+                raise ConversationCancelled()
+            try:
+                text = chunk.text
+            except ValueError:
+                # 部分片段可能沒有文字內容（例如僅含安全性資訊），直接略過
+                continue
+            if text:
+                parts.append(text)
+                on_chunk(text)
+        return ''.join(parts).strip()
+    
+    async def _call_model(self, prompt, on_chunk=None, call_type='dialogue', session_id=None, round_num=None, max_chars=None):
+        """
+        在排程器的執行緒池中呼叫模型；模型與生成設定依呼叫類型決定，max_chars 為輸出字數上限。
+        啟用快取的呼叫類型先查快取。
+        每次嘗試都要經過 call_scheduler 的准入佇列，可重試的錯誤以含抖動的指數退避重試，
+        退避期間不佔用呼叫名額；串流已送出片段後就不再重試，避免前端出現重複內容。
+        排隊、模型與退避時間分別記入指標與會話時間軸。
+        會話被取消時立即結束等待；仍在執行緒中的呼叫由取消權杖中止串流，呼叫名額等執行緒真正結束才釋放。
+        """
+        started_at = time.time()
+        model_name = self.model_name_for(call_type)
+        generation_config = self.generation_config(call_type, model_name, max_chars)
+        cache_key = None
+        if call_type in LLM_CACHE_CALL_TYPES:
+            cache_key = ResponseCache.make_key(prompt, model_name, generation_config)
+            cached = self.response_cache.get(cache_key, call_type)
+            if cached is None and self.response_cache.db is not None:
+                cached = await asyncio.to_thread(self.response_cache.load, cache_key, call_type)
+            if cached is not None:
+                if on_chunk is not None:
+                    on_chunk(cached)
+                metrics.inc('model_calls_total', call_type=call_type, outcome='cached')
+                self.record_timeline(session_id, call_type, started_at, round_num, cached=True)
+                return cached
+        
+        streamed = []
+        def forward(text):
+            streamed.append(True)
+            on_chunk(text)
+        
+        tokens = estimate_tokens(prompt)
+        # 批次會話共用同一個輪替鍵，整個批次只佔一份輪替名額，不會擠掉互動中的使用者
+        conversation = self.conversations.get(session_id)
+        queue_key = conversation.get('queue_key', session_id) if conversation else session_id
+        cancelled = self.cancel_events.get(session_id)
+        queue_seconds = 0.0
+        model_seconds = 0.0
+        self.model_calls[session_id] = self.model_calls.get(session_id, 0) + 1
+        try:
+            for attempt in range(MODEL_MAX_RETRIES + 1):
+                queued_at = time.perf_counter()
+                try:
+                    await self.call_scheduler.acquire(queue_key, tokens)
+                except asyncio.CancelledError:
+                    metrics.inc('model_calls_total', call_type=call_type, outcome='cancelled')
+                    raise
+                waited = time.perf_counter() - queued_at
+                queue_seconds += waited
+                metrics.observe('model_queue_wait_seconds', waited, call_type=call_type)
+                called_at = time.perf_counter()
+                call = asyncio.ensure_future(asyncio.to_thread(
+                    self._generate_text, call_type, prompt, forward if on_chunk is not None else None, generation_config, cancelled
+                ))
+                call.add_done_callback(self._release_call)
+                try:
+                    text = await asyncio.shield(call)
+                    break
+                except asyncio.CancelledError:
+                    metrics.inc('model_calls_total', call_type=call_type, outcome='cancelled')
+                    self.record_timeline(
+                        session_id, call_type, started_at, round_num, model=model_name, queue_seconds=queue_seconds,
+                        model_seconds=model_seconds + time.perf_counter() - called_at, attempts=attempt + 1, cancelled=True
+                    )
+                    raise
+                except Exception as e:
+                    error = type(e).__name__
+                    metrics.inc('model_errors_total', call_type=call_type, error=error)
+                    if attempt >= MODEL_MAX_RETRIES or streamed or not is_retryable_error(e):
+                        metrics.inc('model_calls_total', call_type=call_type, outcome='error')
+                        self.record_timeline(
+                            session_id, call_type, started_at, round_num, model=model_name, queue_seconds=queue_seconds,
+                            model_seconds=model_seconds + time.perf_counter() - called_at, attempts=attempt + 1, error=error
+                        )
+                        raise
+                    metrics.inc('model_retries_total', call_type=call_type, error=error)
+                    delay = random.uniform(0, min(MODEL_RETRY_MAX_SECONDS, MODEL_RETRY_BASE_SECONDS * 2 ** attempt))
+                    logger.warning(f"模型呼叫失敗，{delay:.1f} 秒後重試（第{attempt + 1}次）: {e}")
+                finally:
+                    elapsed = time.perf_counter() - called_at
+                    model_seconds += elapsed
+                    metrics.observe('model_call_seconds', elapsed, call_type=call_type)
+                await asyncio.sleep(delay)
+                metrics.observe('conversation_sleep_seconds', delay, reason='retry_backoff')
+        finally:
+            self.model_calls[session_id] -= 1
+            if not self.model_calls[session_id]:
+                del self.model_calls[session_id]
+        
+        if model_status['state'] != 'ready':
+            model_status.update(state='ready', error=None)
+        prompt_tokens = approx_tokens(prompt)
+        output_tokens = approx_tokens(text)
+        metrics.inc('model_calls_total', call_type=call_type, outcome='ok')
+        metrics.inc('model_prompt_tokens_total', prompt_tokens, call_type=call_type)
+        metrics.inc('model_output_tokens_total', output_tokens, call_type=call_type)
+        self.record_timeline(
+            session_id, call_type, started_at, round_num, model=model_name, queue_seconds=queue_seconds, model_seconds=model_seconds,
+            attempts=attempt + 1, prompt_tokens=prompt_tokens, output_tokens=output_tokens
+        )
+        
+        if cache_key is not None and text:
+            expires_at = self.response_cache.set(cache_key, text)
+            if self.response_cache.db is not None:
+                await asyncio.to_thread(self.response_cache.persist, cache_key, text, expires_at)
+        return text
+    
+    def _release_call(self, call):
+        """模型呼叫的執行緒結束時釋放名額；會話已取消時順便取走例外，避免未讀取例外的警告"""
+        if not call.cancelled():
+            call.exception()
+        self.call_scheduler.release()
+    
+    async def generate_story_outline(self, session_id, on_chunk=None, raise_errors=False):
+        """生成故事大綱；raise_errors 為 True 時（批次模式）失敗直接拋出，而不是回傳 None"""
         try:
             conversation = self.conversations[session_id]
             
@@ -70,23 +1639,33 @@ class ConversationManager:
 請直接回答故事大綱，不需要其他說明，也不要試圖使用加粗等文字格式：
 """
             
-            # 使用 asyncio.to_thread 執行同步的 API 呼叫，避免阻塞
-            response = await asyncio.to_thread(self.model.generate_content, outline_prompt)
-            outline = response.text.strip()
+            # 在執行緒池執行同步的 API 呼叫，避免阻塞事件迴圈
+            outline = await self._call_model(outline_prompt, on_chunk, call_type='outline', session_id=session_id)
             
             # 儲存故事大綱
             conversation['story_outline'] = outline
+            self.persist(session_id)
             
             return outline
             
         except Exception as e:
             logger.error(f"生成故事大綱時發生錯誤: {e}")
+            if raise_errors:
+                raise
             return None
     
-    def generate_character_prompt(self, character_name, character_description, topic, conversation_history, word_limit, story_outline, current_round, total_rounds):
-        """生成角色專屬的提示詞，基於故事大綱"""
+    def generate_character_prompt(self, character_name, character_description, topic, conversation_history, word_limit, story_outline, current_round, total_rounds, history_summary=None):
+        """
+        生成角色專屬的提示詞，基於故事大綱。
+        固定不變的角色設定、大綱與規則放在最前面，每輪都相同，方便模型端重用前綴快取；
+        會變動的摘要、近期對話與進度放在後面。conversation_history 只需傳入視窗內的近期對話。
+        """
         
         # 構建對話歷史
+        summary_text = ""
+        if history_summary:
+            summary_text = f"先前對話摘要：\n{history_summary}\n"
+        
         history_text = ""
         if conversation_history:
             history_text = "目前的對話內容：\n"
@@ -110,11 +1689,7 @@ class ConversationManager:
 故事大綱：
 {story_outline}
 對話主題：{topic}
-對話紀錄：{history_text}
-非語言的資訊：{progress_info}
-當前階段：{stage}
-請以 {character_name} 的身份，根據故事大綱的發展脈絡，針對當前對話內容進行回應。
-要求：
+回應要求：
 1. 嚴格按照角色設定的性格、背景和特點來回應
 2. 回應要符合故事大綱的發展方向
 3. 考慮當前對話階段，確保對話有意義的推進，不要重複上次的對話。
@@ -123,13 +1698,50 @@ class ConversationManager:
 6. 展現角色獨特的觀點和立場
 7. 推動對話向故事大綱的方向發展
 8. 切勿與上一次的對話相同
+{summary_text}對話紀錄：{history_text}
+非語言的資訊：{progress_info}
+當前階段：{stage}
+請以 {character_name} 的身份，根據故事大綱的發展脈絡，針對當前對話內容進行回應。
 請直接以 {character_name} 的身份回應，不要添加任何前綴或說明：
 """
         
         return prompt
     
-    async def generate_response(self, session_id, current_role):
-        """生成 AI 回應"""
+    async def update_history_summary(self, session_id):
+        """
+        對話超出提示詞視窗時，把較舊的訊息摺疊進滾動摘要，讓每輪的輸入長度維持固定。
+        一次摺疊到只剩半個視窗，摘要呼叫的次數因此分攤到多輪。
+        """
+        conversation = self.conversations[session_id]
+        history = conversation['conversation_history']
+        folded = conversation['summarized_count']
+        if PROMPT_HISTORY_WINDOW <= 0 or len(history) - folded <= PROMPT_HISTORY_WINDOW:
+            return
+        
+        fold_until = len(history) - PROMPT_HISTORY_WINDOW // 2
+        folded_text = "".join(f"{msg['role']}: {msg['content']}\n" for msg in history[folded:fold_until])
+        
+        summary_prompt = f"""
+請將以下對話濃縮成一段摘要，保留兩位角色的立場變化、已發生的關鍵事件與尚未解決的問題。
+對話主題：{conversation['topic']}
+既有摘要：{conversation['history_summary'] or '無'}
+新增對話：
+{folded_text}
+摘要字數不超過{HISTORY_SUMMARY_MAX_CHARS}字，直接回答摘要內容，不要添加任何前綴或說明：
+"""
+        try:
+            summary = await self._call_model(summary_prompt, call_type='summary', session_id=session_id)
+        except Exception as e:
+            logger.error(f"生成對話摘要時發生錯誤: {e}")
+            # 摘要失敗時退而保留既有摘要與新增對話的尾端，仍維持長度上限
+            summary = (conversation['history_summary'] + "\n" + folded_text).strip()[-HISTORY_SUMMARY_MAX_CHARS:]
+        
+        conversation['history_summary'] = summary
+        conversation['summarized_count'] = fold_until
+        self.persist(session_id)
+    
+    async def generate_response(self, session_id, current_role, on_chunk=None):
+        """生成 AI 回應；重試用盡後直接拋出，由呼叫端決定如何處理，不以道歉訊息代替"""
         try:
             conversation = self.conversations[session_id]
             
@@ -142,37 +1754,45 @@ class ConversationManager:
             # 計算當前輪數（基於 conversation_history 的長度）
             current_round = len(conversation['conversation_history']) // 2 + 1
             
+            # 較舊的對話摺疊進摘要，提示詞只帶入視窗內的近期對話
+            await self.update_history_summary(session_id)
+            recent_history = conversation['conversation_history'][conversation['summarized_count']:]
+            
             prompt = self.generate_character_prompt(
                 current_role,
                 character_description,
                 conversation['topic'],
-                conversation['conversation_history'],
+                recent_history,
                 conversation['word_limit'],
                 conversation['story_outline'],
                 current_round,
-                conversation['rounds']
+                conversation['rounds'],
+                history_summary=conversation['history_summary']
             )
             
-            # 使用 asyncio.to_thread 執行同步的 API 呼叫
-            response = await asyncio.to_thread(self.model.generate_content, prompt)
-            return response.text.strip()
+            # 在執行緒池執行同步的 API 呼叫
+            return await self._call_model(
+                prompt, on_chunk, call_type='dialogue', session_id=session_id, max_chars=conversation['word_limit']
+            )
             
         except Exception as e:
             logger.error(f"生成回應時發生錯誤: {e}")
-            return f"抱歉，{current_role} 暫時無法回應，請稍後再試。"
+            raise
 
     # NEW: 生成旁白描述的函數
-    async def generate_narrator_description(self, session_id):
-        """生成旁白描述"""
+    async def generate_narrator_description(self, session_id, round_num=None, on_chunk=None):
+        """生成旁白描述；指定 round_num 時只取該輪的對話，管線化執行時不受下一輪進度影響。失敗時直接拋出"""
         try:
             conversation = self.conversations[session_id]
+            if round_num is None:
+                round_num = conversation['current_round']
             
             # 獲取最近的對話內容作為旁白的上下文
             # 這裡我們使用 conversation['messages'] 因為它包含了所有已發送的內容
             # 但旁白的提示詞應只關注最近的對話 "實質內容"
             
-            # 從 conversation_history 中獲取最新的兩則對話（如果存在）
-            recent_dialogue = conversation['conversation_history'][-2:]
+            # 從 conversation_history 中獲取該輪的兩則對話（如果存在）
+            recent_dialogue = conversation['conversation_history'][max(round_num - 1, 0) * 2:round_num * 2]
             
             recent_dialogue_text = ""
             if recent_dialogue:
@@ -187,7 +1807,7 @@ class ConversationManager:
 角色1: {conversation['role1']} ({conversation['role1_description']})
 角色2: {conversation['role2']} ({conversation['role2_description']})
 故事大綱：{conversation['story_outline']}
-目前進度：第{conversation['current_round']}輪
+目前進度：第{round_num}輪
 {recent_dialogue_text}
 請根據以上資訊和最新的對話內容，以客觀、生動的第三人稱視角，簡潔地描述當前場景的動作、非語言資訊、氛圍變化，以及角色可能展現出的情緒或反應。
 請注意：
@@ -196,256 +1816,1334 @@ class ConversationManager:
 3. 直接回答旁白內容，不要添加任何前綴、後綴或說明。
 4. 切勿與上一次的對話相同
 """
-            # 使用 asyncio.to_thread 執行同步的 API 呼叫
-            response = await asyncio.to_thread(self.model.generate_content, narrator_prompt)
-            return response.text.strip()
+            # 在執行緒池執行同步的 API 呼叫
+            return await self._call_model(narrator_prompt, on_chunk, call_type='narrator', session_id=session_id, round_num=round_num)
             
         except Exception as e:
             logger.error(f"生成旁白描述時發生錯誤: {e}")
-            return "（旁白描述生成失敗，請聯繫管理員。）" # 提供一個更友好的錯誤提示
+            raise
     
     def add_message(self, session_id, msg_type, role=None, content=None, round_num=None, is_role1=None):
         """
-        添加訊息到對話歷史 (統一處理對話和旁白訊息)。
+        添加訊息到對話歷史 (統一處理對話和旁白訊息)，回傳該訊息的序號。
         msg_type: 'dialogue' 或 'narrator'
         """
         if session_id in self.conversations:
             if msg_type == 'dialogue':
-                message_obj = {
-                    'type': 'dialogue',
-                    'role': role,
-                    'content': content,
-                    'round': round_num,
-                    'is_role1': is_role1
-                }
-                self.conversations[session_id]['messages'].append(message_obj)
-                self.conversations[session_id]['conversation_history'].append({
-                    'role': role,
-                    'content': content
-                }) # 只有對話內容才加入 conversation_history
+                # 對話訊息會自動出現在 conversation_history 檢視中
+                message_obj = Message('dialogue', content, round_num, role=role, is_role1=is_role1)
             elif msg_type == 'narrator':
-                message_obj = {
-                    'type': 'narrator',
-                    'content': content,
-                    'round': round_num # 旁白也標註輪次
-                }
-                self.conversations[session_id]['messages'].append(message_obj)
-            return True
+                message_obj = Message('narrator', content, round_num) # 旁白也標註輪次
+            else:
+                return False
+            self.conversations[session_id]['messages'].append(message_obj)
+            if self.transcribed(self.conversations[session_id]):
+                self.transcripts.append_message(session_id, message_obj)
+            self.persist(session_id)
+            return message_obj.seq
         return False
     
-    def get_conversation(self, session_id):
-        """獲取對話資訊"""
-        return self.conversations.get(session_id)
+    def get_conversation(self, session_id, load_transcript=True):
+        """
+        獲取對話資訊；本程序沒有在驅動的會話改從共用儲存讀取，都沒有時再從逐字稿儲存讀回已卸載的會話。
+        記憶體後端時讀回的會話放回工作集，之後依閒置時間與 LRU 淘汰。
+        """
+        conversation = self.conversations.get(session_id)
+        if conversation is None and self.store.shared:
+            conversation = self.store.load(session_id)
+        elif conversation is not None:
+            self.touch(session_id)
+        if conversation is None and load_transcript and self.transcripts is not None:
+            conversation = self.transcripts.load(session_id)
+            if conversation is not None and not self.store.shared:
+                self.conversations[session_id] = conversation
+                self.touch(session_id)
+                self.evict_idle()
+        return conversation
+
+class SessionControl:
+    """
+    單一執行中會話的控制狀態：取消權杖與暫停閘門。
+    cancelled 是 threading.Event，模型呼叫的執行緒也會檢查；resumed 清除時會話停在下一個檢查點，狀態保持不變。
+    """
+    
+    def __init__(self):
+        self.cancelled = Event()
+        self.reason = None # 取消原因：stopped / restarted / disconnected
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.paused_by = None # 暫停來源：user（客戶端要求）/ detached（斷線寬限期）
+        self.task = None
+        self.finished = Event()
+    
+    def cancel_task(self):
+        # 任務尚未開始時由 _run_session 開頭檢查取消權杖
+        if self.task is not None:
+            self.task.cancel()
+
+class ConversationScheduler:
+    """以單一長駐事件迴圈驅動所有對話會話，取代每個會話一條執行緒、每次呼叫一個 asyncio.run 的作法"""
+    
+    def __init__(self, max_sessions=MAX_ACTIVE_SESSIONS, max_model_calls=MAX_INFLIGHT_MODEL_CALLS):
+        self.max_sessions = max_sessions
+        self.max_model_calls = max_model_calls
+        self.loop = None
+        self.session_slots = asyncio.Semaphore(max_sessions)
+        self.tasks = {}
+        self.controls = {} # session_id -> SessionControl
+        self._lock = Lock()
+    
+    def _ensure_loop(self):
+        """第一次提交會話時才啟動事件迴圈執行緒，之後所有會話共用同一個迴圈"""
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                # 模型呼叫是同步 API，交由大小與呼叫上限一致的執行緒池處理
+                loop.set_default_executor(ThreadPoolExecutor(
+                    max_workers=self.max_model_calls, thread_name_prefix='model-call'
+                ))
+                ready = Event()
+                thread = Thread(target=self._run_loop, args=(loop, ready), name='conversation-scheduler')
+                thread.daemon = True
+                thread.start()
+                ready.wait()
+                self.loop = loop
+            return self.loop
+    
+    @staticmethod
+    def _run_loop(loop, ready):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+    
+    def submit(self, session_id, coroutine_func):
+        """提交一個會話協程；超過會話上限時會排隊等待空位"""
+        loop = self._ensure_loop()
+        control = self.controls[session_id] = SessionControl()
+        conversation_manager.cancel_events[session_id] = control.cancelled
+        future = asyncio.run_coroutine_threadsafe(self._run_session(session_id, coroutine_func, control), loop)
+        self.tasks[session_id] = future
+        return future
+    
+    @property
+    def store(self):
+        return conversation_manager.store
+    
+    def _driven_elsewhere(self, session_id):
+        """共用儲存時，會話是否正由其他 worker 驅動或排隊中（停止／暫停要求改寫入控制紀錄）"""
+        if not self.store.shared:
+            return False
+        conversation = conversation_manager.get_conversation(session_id, load_transcript=False)
+        return conversation is not None and conversation.get('status') in ('pending', 'running')
+    
+    def cancel(self, session_id, reason, wait=None):
+        """
+        取消會話：設定取消權杖並中斷會話任務目前的等待（排隊、模型呼叫、呈現間隔）。
+        會話由其他 worker 驅動時寫入控制紀錄，由持有租約的 worker 輪詢到後取消。
+        wait 為秒數時等待任務收尾（租約釋放）再返回。回傳是否有這個執行中的會話。
+        """
+        control = self.controls.get(session_id)
+        if control is None:
+            if not self._driven_elsewhere(session_id):
+                return False
+            self.store.set_control(session_id, cancel=reason)
+            if wait:
+                deadline = time.time() + wait
+                while self.store.is_leased(session_id) and time.time() < deadline:
+                    time.sleep(0.1)
+            return True
+        control.reason = reason
+        control.cancelled.set()
+        self.loop.call_soon_threadsafe(control.cancel_task)
+        if wait:
+            control.finished.wait(wait)
+        return True
+    
+    def pause(self, session_id, paused_by='user'):
+        """
+        暫停會話：進行中的回合照常完成，之後停在下一個檢查點，直到 resume。
+        使用者自己的暫停與生成失敗的暫停不會被斷線造成的暫停取代，否則重新連線時 resume(paused_by='detached') 會把它一併解除。
+        """
+        control = self.controls.get(session_id)
+        if control is not None and not control.cancelled.is_set():
+            current = control.paused_by
+        elif self._driven_elsewhere(session_id):
+            control, current = None, (self.store.get_control(session_id) or {}).get('paused_by')
+        else:
+            return False
+        if paused_by == 'detached' and current in ('user', 'generation_failed'):
+            return True
+        self._request_pause(session_id, control, paused_by)
+        return True
+    
+    def resume(self, session_id, paused_by=None):
+        """繼續已暫停的會話；指定 paused_by 時只解除該來源造成的暫停（例如重新連線不會解除使用者自己的暫停）"""
+        control = self.controls.get(session_id)
+        if control is not None:
+            current = control.paused_by
+        elif self.store.shared:
+            current = (self.store.get_control(session_id) or {}).get('paused_by')
+        else:
+            return False
+        if current is None or (paused_by is not None and current != paused_by):
+            return False
+        self._request_pause(session_id, control, None)
+        return True
+    
+    def _request_pause(self, session_id, control, paused_by):
+        """共用儲存時暫停狀態以控制紀錄為準（驅動的 worker 依它同步），本程序有這個會話時同時直接套用"""
+        if self.store.shared:
+            self.store.set_control(session_id, paused_by=paused_by)
+        if control is not None:
+            self._apply_pause(session_id, control, paused_by)
+    
+    def _apply_pause(self, session_id, control, paused_by):
+        control.paused_by = paused_by
+        conversation = conversation_manager.conversations.get(session_id)
+        if conversation is not None:
+            conversation['paused'] = paused_by
+        self.loop.call_soon_threadsafe(control.resumed.clear if paused_by else control.resumed.set)
+    
+    def apply_requests(self, session_id):
+        """由持有租約的 worker 呼叫：套用控制紀錄中其他 worker 寫入的停止與暫停／繼續要求"""
+        control = self.controls.get(session_id)
+        if control is None or control.cancelled.is_set():
+            return
+        requested = self.store.get_control(session_id) or {}
+        if requested.get('cancel'):
+            self.cancel(session_id, requested['cancel'])
+        elif requested.get('paused_by') != control.paused_by:
+            self._apply_pause(session_id, control, requested.get('paused_by'))
+    
+    def spawn(self, coroutine):
+        """在共用事件迴圈上執行不屬於互動會話的協程（例如批次工作），不佔用會話名額"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._ensure_loop())
+    
+    async def _run_session(self, session_id, coroutine_func, control):
+        control.task = asyncio.current_task()
+        queued_at = time.time()
+        try:
+            if control.cancelled.is_set():
+                raise asyncio.CancelledError()
+            async with self.session_slots:
+                metrics.observe('session_queue_wait_seconds', time.time() - queued_at)
+                conversation_manager.record_timeline(session_id, 'session_queue', queued_at)
+                await coroutine_func(session_id)
+        except asyncio.CancelledError:
+            # 還在等待會話名額時就被取消：尚未開始生成，只更新狀態；斷線逾期則直接刪除
+            conversation = conversation_manager.conversations.get(session_id)
+            if conversation is not None and conversation.get('status') == 'pending':
+                conversation['status'] = 'cancelled'
+                metrics.inc('conversations_total', status='cancelled')
+                if control.reason == 'disconnected':
+                    conversation_manager.delete_conversation(session_id)
+        finally:
+            control.finished.set()
+            if self.controls.get(session_id) is control:
+                del self.controls[session_id]
+                self.tasks.pop(session_id, None)
+                conversation_manager.cancel_events.pop(session_id, None)
+    
+    def stats(self):
+        """回傳排程狀態：排隊中與執行中的會話數"""
+        pending = len(self.tasks)
+        queued = len(getattr(self.session_slots, '_waiters', None) or ())
+        return {
+            'sessions': pending,
+            'queued_sessions': queued,
+            'active_sessions': pending - queued,
+            'max_sessions': self.max_sessions,
+            'max_model_calls': self.max_model_calls
+        }
 
 conversation_manager = ConversationManager()
+conversation_scheduler = ConversationScheduler()
+
+metrics.register_gauge('active_sessions', '正在執行的會話數', lambda: conversation_scheduler.stats()['active_sessions'])
+metrics.register_gauge('queued_sessions', '等待排程器空位的會話數', lambda: conversation_scheduler.stats()['queued_sessions'])
+metrics.register_gauge('stored_sessions', '本程序記憶體中的會話數', lambda: len(conversation_manager.conversations))
+metrics.register_gauge('model_calls_in_flight', '進行中的模型呼叫數', lambda: conversation_manager.call_scheduler.in_flight)
+metrics.register_gauge('model_calls_queued', '在准入佇列中等待的模型呼叫數', lambda: conversation_manager.call_scheduler.stats()['queued_calls'])
+
+# 靜態圖片變體：由 build_assets.py 輸出到 static/dist，檔名含內容雜湊，因此可以永久快取
+ASSET_DIR = os.path.join(app.static_folder, 'dist')
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def load_asset_manifest(path=os.path.join(ASSET_DIR, 'manifest.json')):
+    """讀取圖片變體清單；尚未建置時回傳空清單，頁面改用原始圖片"""
+    try:
+        with open(path, encoding='utf-8') as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        logger.info("找不到 static/dist/manifest.json，使用原始圖片（可執行 build_assets.py 建置）")
+        return {'formats': [], 'images': {}}
+
+asset_manifest = load_asset_manifest()
+
+@app.template_global()
+def asset_url(path, width, format='png'):
+    """取得寬度不小於 width 的變體網址；沒有變體時回傳原始路徑"""
+    entry = asset_manifest['images'].get(path)
+    if not entry or format not in entry:
+        return path
+    variants = entry[format]
+    chosen = next((variant for variant in variants if variant[1] >= width), variants[-1])
+    return f"/assets/{chosen[0]}"
+
+@app.template_global()
+def asset_picture(path, size, **attrs):
+    """輸出 <picture>：AVIF / WebP 來源加上 PNG 後備，瀏覽器依顯示尺寸從 srcset 挑選寬度（與前端的 pictureHtml 相同）"""
+    attr_text = ''.join(f' {key}="{escape(value)}"' for key, value in attrs.items())
+    entry = asset_manifest['images'].get(path)
+    if not entry:
+        return Markup(f'<img src="{escape(path)}" width="{size}" height="{size}"{attr_text}>')
+    
+    def srcset(format):
+        return ', '.join(f"/assets/{variant} {width}w" for variant, width in entry[format])
+    
+    sources = ''.join(
+        f'<source type="image/{format}" srcset="{srcset(format)}" sizes="{size}px">'
+        for format in asset_manifest['formats'] if format != 'png'
+    )
+    return Markup(
+        f'<picture>{sources}<img src="/assets/{entry["png"][0][0]}" srcset="{srcset("png")}" sizes="{size}px" '
+        f'width="{size}" height="{size}"{attr_text}></picture>'
+    )
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """建置產物：一年且 immutable 的快取；ETag 與條件式請求由 send_from_directory 處理"""
+    response = send_from_directory(ASSET_DIR, filename, max_age=ASSET_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
+class PrecompressedPage:
+    """渲染一次的頁面：預先保留原文、gzip 與 brotli 版本，依 Accept-Encoding 回應，並以 ETag 處理重新驗證"""
+    
+    def __init__(self, html):
+        self.body = html.encode('utf-8')
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+        self.encodings = {'gzip': gzip.compress(self.body, 9)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(self.body, quality=11)
+    
+    def response(self, req):
+        if req.if_none_match.contains_weak(self.etag):
+            response = Response(status=304)
+        else:
+            encoding = next((name for name in ('br', 'gzip') if name in self.encodings and req.accept_encodings[name]), None)
+            response = Response(self.encodings.get(encoding, self.body), mimetype='text/html')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        # 各壓縮版本內容相同，使用弱 ETag；頁面引用的圖片網址會隨建置改變，所以每次都要重新驗證
+        response.set_etag(self.etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+index_page = None
 
 @app.route('/')
 def index():
-    """主頁面"""
-    return render_template('index.html')
+    """主頁面：第一次請求時渲染並壓縮，之後直接回應快取的內容"""
+    global index_page
+    if index_page is None:
+        index_page = PrecompressedPage(render_template('index.html', asset_manifest=asset_manifest))
+    return index_page.response(request)
+
+def parse_scenario(data):
+    """把前端或批次輸入的對話設定轉成 create_conversation 的參數；缺少必要欄位或格式錯誤時拋出 ValueError"""
+    scenario = {
+        'role1': data.get('role1', '').strip(),
+        'role2': data.get('role2', '').strip(),
+        'role1_description': data.get('role1Description', '').strip(),
+        'role2_description': data.get('role2Description', '').strip(),
+        'topic': data.get('topic', '').strip(),
+        'narrator_mode': bool(data.get('narratorMode', False)) # NEW: 接收旁白模式設定
+    }
+    if not all([scenario['role1'], scenario['role2'], scenario['topic']]):
+        raise ValueError('請完整填寫所有必要資訊')
+    try:
+        scenario['word_limit'] = int(data.get('wordLimit', 150))
+        scenario['rounds'] = int(data.get('rounds', 8))
+    except (TypeError, ValueError):
+        raise ValueError('字數限制與輪數必須是整數')
+    return scenario
+
+# 重新開始對話時等待舊任務收尾的秒數上限
+RESTART_CANCEL_TIMEOUT_SECONDS = float(os.getenv('RESTART_CANCEL_TIMEOUT_SECONDS', 5))
+
+def is_local_socket(sid):
+    """sid 是否為目前連線在本程序的 Socket.IO 客戶端"""
+    return socketio.server.manager.is_connected(sid, '/')
+
+# 本程序的連線目前擁有的會話：sid -> session_id，斷線時據此標記會話
+owned_sessions = {}
+
+def resume_token(session_id):
+    """會話的續接權杖：以 SECRET_KEY 簽署會話 ID，與連線的 sid 無關，任何 worker 都能驗證而不必另外儲存"""
+    return hmac.new(app.config['SECRET_KEY'].encode('utf-8'), session_id.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def valid_resume_token(session_id, token):
+    return isinstance(token, str) and hmac.compare_digest(token, resume_token(session_id))
+
+def session_owner(session_id):
+    """目前控制會話的連線 sid（記在控制紀錄，所有 worker 共用）"""
+    return (conversation_manager.store.get_control(session_id) or {}).get('owner')
+
+def take_ownership(sid, session_id):
+    """讓 sid 加入會話房間並成為擁有者，直接取代原本的擁有者（例如伺服器還沒察覺斷線的舊連線）"""
+    socketio.server.enter_room(sid, session_id, namespace='/')
+    owned_sessions[sid] = session_id
+    conversation_manager.store.set_control(session_id, owner=sid)
+
+def release_previous(sid):
+    """同一個連線重新開始或分支時，離開原本的會話房間並取消該對話，等它收尾，避免舊任務繼續呼叫模型"""
+    previous = owned_sessions.pop(sid, None)
+    if previous is None:
+        return
+    socketio.server.leave_room(sid, previous, namespace='/')
+    if session_owner(previous) == sid:
+        conversation_scheduler.cancel(previous, 'restarted', wait=RESTART_CANCEL_TIMEOUT_SECONDS)
+
+def begin_conversation(data, owner=None):
+    """
+    以隨機會話 ID 建立會話並交由排程器開始，回傳（回應內容, HTTP 狀態碼）。
+    指定 owner（連線 sid）時該連線直接加入會話房間並成為擁有者；回應附上 resume_token 供重新連線時續接。
+    """
+    try:
+        scenario = parse_scenario(data)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    
+    # 同一個客戶端重新開始時先取消舊的對話
+    if owner is not None:
+        release_previous(owner)
+    
+    # 創建對話會話，傳遞 narrator_mode
+    session_id = uuid.uuid4().hex
+    conversation_manager.create_conversation(session_id, **scenario)
+    if owner is not None:
+        take_ownership(owner, session_id)
+    
+    # 交由共用排程器在背景開始對話（包含生成故事大綱）
+    conversation_scheduler.submit(session_id, run_conversation_background)
+    
+    return {
+        'success': True,
+        'session_id': session_id,
+        'resume_token': resume_token(session_id),
+        'message': '對話已開始'
+    }, 200
 
 @app.route('/api/start-conversation', methods=['POST'])
 def start_conversation():
-    """開始對話的 API 端點"""
+    """
+    開始對話的 API 端點。
+    帶 socketId 時該 Socket.IO 連線直接加入會話房間並成為擁有者，但只接受連線在本程序的 sid，
+    避免呼叫端冒用其他客戶端的 sid 取代其對話；多 worker 部署時 HTTP 請求未必落在同一個 worker，
+    網頁改用 start_conversation 事件。未提供時客戶端需以 join_conversation 事件帶入 resume_token 加入。
+    """
     try:
-        data = request.json
-        session_id = request.sid if hasattr(request, 'sid') else str(time.time())
-        
-        role1 = data.get('role1', '').strip()
-        role2 = data.get('role2', '').strip()
-        role1_description = data.get('role1Description', '').strip()
-        role2_description = data.get('role2Description', '').strip()
-        topic = data.get('topic', '').strip()
-        word_limit = int(data.get('wordLimit', 150))
-        rounds = int(data.get('rounds', 8))
-        narrator_mode = data.get('narratorMode', False) # NEW: 接收旁白模式設定
-        
-        if not all([role1, role2, topic]):
-            return jsonify({'error': '請完整填寫所有必要資訊'}), 400
-        
-        # 創建對話會話，傳遞 narrator_mode
-        conversation_manager.create_conversation(
-            session_id, role1, role2, role1_description, role2_description, 
-            topic, word_limit, rounds, narrator_mode
-        )
-        
-        # 在背景開始對話（包含生成故事大綱）
-        thread = Thread(target=run_conversation_background, args=(session_id,))
-        thread.daemon = True
-        thread.start()
+        data = request.json or {}
+        socket_id = data.get('socketId')
+        if socket_id and not is_local_socket(socket_id):
+            return jsonify({'error': '無效的連線 ID'}), 400
         
-        return jsonify({
-            'success': True,
-            'session_id': session_id,
-            'message': '對話已開始'
-        })
+        payload, status = begin_conversation(data, owner=socket_id or None)
+        return jsonify(payload), status
         
     except Exception as e:
         logger.error(f"開始對話時發生錯誤: {e}")
         return jsonify({'error': '開始對話失敗'}), 500
 
-def run_conversation_background(session_id):
-    """在背景執行對話流程，新增旁白生成"""
+@socketio.on('start_conversation')
+def handle_start_conversation(data):
+    """經由 Socket.IO 開始對話：本連線成為會話的擁有者；回應（ack）內容同 /api/start-conversation"""
+    if not isinstance(data, dict):
+        return {'success': False, 'error': '請完整填寫所有必要資訊'}
     try:
-        conversation = conversation_manager.conversations[session_id]
+        payload, _ = begin_conversation(data, owner=request.sid)
+        return payload
+    except Exception as e:
+        logger.error(f"開始對話時發生錯誤: {e}")
+        return {'success': False, 'error': '開始對話失敗'}
+
+def emit_to_session(session_id, event, data=None):
+    """只把事件送進該會話的房間，避免廣播給所有連線中的客戶端"""
+    socketio.emit(event, data, to=session_id)
+
+def emit_queue_position(session_id, position):
+    """模型呼叫排隊時通知客戶端目前的排隊位置（0 表示已開始處理）"""
+    if session_id is not None:
+        emit_to_session(session_id, 'queue_position', {'position': position})
+
+conversation_manager.call_scheduler.on_queue_position = emit_queue_position
+
+def make_chunk_emitter(session_id, kind, **fields):
+    """建立串流回呼：每收到一段模型輸出就發送 message_chunk 事件；未啟用串流時回傳 None"""
+    if not STREAM_RESPONSES:
+        return None
+    
+    def on_chunk(text):
+        emit_to_session(session_id, 'message_chunk', {'kind': kind, **fields, 'delta': text})
+    
+    return on_chunk
+
+def emit_message_done(session_id, event, payload):
+    """回合結束時送出最終內容；串流模式改用 message_done 讓前端以完整文字取代暫存的串流訊息"""
+    if STREAM_RESPONSES:
+        emit_to_session(session_id, 'message_done', {'kind': 'narrator' if event == 'new_narrator_message' else 'dialogue', **payload})
+    else:
+        emit_to_session(session_id, event, payload)
+
+class ChunkGate:
+    """串流片段閘門：前一則訊息（上一輪的旁白）送出前先暫存片段，開啟後依序補送，確保前端顯示順序"""
+    
+    def __init__(self, on_chunk):
+        self.on_chunk = on_chunk
+        self.buffer = []
+        self.opened = False
+        self._lock = Lock()
+    
+    def __call__(self, text):
+        with self._lock:
+            if not self.opened:
+                self.buffer.append(text)
+                return
+        self.on_chunk(text)
+    
+    def open(self):
+        with self._lock:
+            self.opened = True
+            buffered, self.buffer = self.buffer, []
+            for text in buffered:
+                self.on_chunk(text)
+
+async def pace(session_id):
+    """訊息之間的呈現間隔；TURN_PACING_SECONDS 為 0 時不等待"""
+    if TURN_PACING_SECONDS > 0:
+        started_at = time.time()
+        await asyncio.sleep(TURN_PACING_SECONDS)
+        metrics.observe('conversation_sleep_seconds', time.time() - started_at, reason='pacing')
+        conversation_manager.record_timeline(session_id, 'pacing', started_at)
+
+async def checkpoint(session_id):
+    """
+    每個回合開始前的檢查點：已取消時中止，暫停時在此等待繼續。
+    取消會直接中斷任務目前的等待，這裡再檢查一次權杖，確保取消後不會再開始新的回合。
+    """
+    control = conversation_scheduler.controls.get(session_id)
+    if control is None:
+        return
+    if conversation_manager.store.shared:
+        conversation_scheduler.apply_requests(session_id)
+    if control.cancelled.is_set():
+        raise asyncio.CancelledError()
+    if not control.resumed.is_set():
+        started_at = time.time()
+        emit_to_session(session_id, 'conversation_paused', {'paused_by': control.paused_by})
+        logger.info(f"對話已暫停 - Session: {session_id}")
+        await control.resumed.wait()
+        metrics.observe('conversation_sleep_seconds', time.time() - started_at, reason='paused')
+        conversation_manager.record_timeline(session_id, 'paused', started_at)
+        emit_to_session(session_id, 'conversation_resumed')
+        logger.info(f"對話繼續 - Session: {session_id}")
+
+async def wait_after_generation_failed(session_id, error, kind, round_num, role=None):
+    """
+    模型呼叫重試用盡：這一回合不寫入任何訊息，通知前端生成失敗並以 generation_failed 暫停會話，
+    使用者按「繼續」後回到呼叫端重新生成同一回合。會話已不在排程器中時照原樣拋出。
+    """
+    if not conversation_scheduler.pause(session_id, 'generation_failed'):
+        raise error
+    emit_to_session(session_id, 'generation_failed', {'kind': kind, 'role': role, 'round': round_num})
+    logger.warning(f"回合生成失敗，暫停等待重試 - Session: {session_id}, 第{round_num}輪, {kind}: {error}")
+    # 暫停閘門經由 call_soon_threadsafe 關閉，先讓出一次讓它生效
+    await asyncio.sleep(0)
+    await checkpoint(session_id)
+
+async def run_dialogue_turn(session_id, round_num, is_role1, wait_for=None):
+    """
+    執行一次角色發言。
+    wait_for: 需先完成並送出的前一則訊息（上一輪的旁白任務），期間模型生成照常進行，只延後顯示
+    """
+    started_at = time.time()
+    conversation = conversation_manager.conversations[session_id]
+    role = conversation['role1'] if is_role1 else conversation['role2']
+    
+    while True:
+        on_chunk = make_chunk_emitter(session_id, 'dialogue', role=role, round=round_num, is_role1=is_role1)
+        gate = None
+        if wait_for is not None and on_chunk is not None:
+            gate = on_chunk = ChunkGate(on_chunk)
+        if wait_for is None:
+            emit_to_session(session_id, 'show_loading', {'role': role})
         
-        # 首先生成故事大綱
-        logger.info(f"開始生成故事大綱 - Session: {session_id}")
-        story_outline = asyncio.run(conversation_manager.generate_story_outline(session_id))
+        generation = asyncio.ensure_future(conversation_manager.generate_response(
+            session_id, role, on_chunk=on_chunk
+        ))
+        
+        try:
+            if wait_for is not None:
+                await wait_for
+                emit_to_session(session_id, 'show_loading', {'role': role})
+                if gate is not None:
+                    gate.open()
+            
+            response = await generation
+            break
+        except Exception as e:
+            await wait_after_generation_failed(session_id, e, 'dialogue', round_num, role=role)
+            wait_for = None
+        finally:
+            # 會話被取消時一併取消仍在進行的生成
+            generation.cancel()
+    
+    seq = conversation_manager.add_message(
+        session_id, 'dialogue', role=role, content=response, 
+        round_num=round_num, is_role1=is_role1
+    )
+    
+    emit_to_session(session_id, 'hide_loading')
+    emit_message_done(session_id, 'new_message', {
+        'seq': seq,
+        'role': role,
+        'content': response,
+        'round': round_num,
+        'is_role1': is_role1
+    })
+    
+    metrics.observe('conversation_turn_seconds', time.time() - started_at, kind='dialogue')
+    logger.info(f"角色{1 if is_role1 else 2}({role})發言完成 - 第{round_num}輪")
+
+async def run_narrator_turn(session_id, round_num, show_loading=True):
+    """生成並送出一輪的旁白；管線化時在背景執行，不顯示載入動畫也不串流，避免與下一輪角色發言交錯"""
+    started_at = time.time()
+    logger.info(f"開始生成旁白描述 - 第{round_num}輪")
+    while True:
+        if show_loading:
+            emit_to_session(session_id, 'show_loading', {'role': '旁白'})
+        try:
+            narrator_content = await conversation_manager.generate_narrator_description(
+                session_id, round_num=round_num,
+                on_chunk=make_chunk_emitter(session_id, 'narrator', round=round_num) if show_loading else None
+            )
+            break
+        except Exception as e:
+            await wait_after_generation_failed(session_id, e, 'narrator', round_num)
+    
+    seq = conversation_manager.add_message(
+        session_id, 'narrator', content=narrator_content, round_num=round_num
+    )
+    
+    if show_loading:
+        emit_to_session(session_id, 'hide_loading')
+    emit_message_done(session_id, 'new_narrator_message', { # 發送新的旁白事件
+        'seq': seq,
+        'content': narrator_content,
+        'round': round_num
+    })
+    metrics.observe('conversation_turn_seconds', time.time() - started_at, kind='narrator')
+    logger.info(f"旁白發言完成 - 第{round_num}輪")
+    await pace(session_id)
+
+async def hold_lease(session_id):
+    """
+    驅動會話期間定期續約；續約失敗代表租約已被其他 worker 取得，任務結束。
+    共用儲存時每 CONTROL_POLL_SECONDS 秒套用一次控制紀錄，其他 worker 收到的停止、暫停與繼續要求由這裡生效。
+    """
+    shared = conversation_manager.store.shared
+    interval = min(CONTROL_POLL_SECONDS, SESSION_LEASE_SECONDS / 3) if shared else SESSION_LEASE_SECONDS / 3
+    renewed_at = time.time()
+    while True:
+        if shared:
+            conversation_scheduler.apply_requests(session_id)
+        await asyncio.sleep(interval)
+        if time.time() - renewed_at >= SESSION_LEASE_SECONDS / 3:
+            if not conversation_manager.renew_lease(session_id):
+                logger.warning(f"會話租約已失效 - Session: {session_id}")
+                return
+            renewed_at = time.time()
+
+async def run_conversation_background(session_id):
+    """
+    在排程器的事件迴圈上執行對話流程，新增旁白生成。
+    必須先取得會話租約，確保同一會話只由一個 worker 驅動；會話已有進度時（例如接手其他 worker）從中斷處繼續。
+    """
+    if not conversation_manager.claim(session_id):
+        logger.info(f"會話已由其他 worker 驅動，略過 - Session: {session_id}")
+        return
+    
+    lease = asyncio.ensure_future(hold_lease(session_id))
+    conversation = conversation_manager.conversations[session_id]
+    pending_narration = None
+    try:
+        conversation['status'] = 'running'
+        conversation_manager.persist(session_id)
+        
+        # 首先生成故事大綱（已有大綱時沿用）
+        story_outline = conversation['story_outline']
+        if not story_outline:
+            logger.info(f"開始生成故事大綱 - Session: {session_id}")
+            started_at = time.time()
+            story_outline = await conversation_manager.generate_story_outline(
+                session_id, on_chunk=make_chunk_emitter(session_id, 'outline')
+            )
+            metrics.observe('conversation_turn_seconds', time.time() - started_at, kind='outline')
         
         if story_outline:
-            socketio.emit('story_outline_generated', {
+            conversation_manager.save_transcript(session_id)
+            emit_to_session(session_id, 'story_outline_generated', {
                 'outline': story_outline
             })
             logger.info(f"故事大綱生成完成 - Session: {session_id}")
         else:
-            socketio.emit('story_outline_error', {
+            emit_to_session(session_id, 'story_outline_error', {
                 'message': '故事大綱生成失敗'
             })
             logger.error(f"故事大綱生成失敗 - Session: {session_id}")
         
-        # 等待一下再開始對話
-        time.sleep(2)
+        await pace(session_id)
         
-        # 開始對話循環
-        for round_num in range(1, conversation['rounds'] + 1):
+        # 從已完成的對話之後開始；歷史為奇數則表示該輪角色1已發言
+        spoken = len(conversation['conversation_history'])
+        start_round = spoken // 2 + 1
+        
+        # 開始對話循環；管線化模式下，上一輪的旁白任務會與本輪角色1的生成同時進行
+        for round_num in range(start_round, conversation['rounds'] + 1):
+            if lease.done():
+                logger.warning(f"失去會話租約，停止驅動 - Session: {session_id}")
+                return
+            
             conversation['current_round'] = round_num # 更新當前輪數
+            conversation_manager.persist(session_id)
             logger.info(f"開始第 {round_num} 輪對話 - Session: {session_id}")
             
             # 角色1發言
-            socketio.emit('show_loading', {
-                'role': conversation['role1']
-            })
-            
-            time.sleep(1)  # 模擬思考時間
-            
-            response1 = asyncio.run(conversation_manager.generate_response(
-                session_id, conversation['role1']
-            ))
-            
-            conversation_manager.add_message(
-                session_id, 'dialogue', role=conversation['role1'], content=response1, 
-                round_num=round_num, is_role1=True
-            )
-            
-            socketio.emit('hide_loading')
-            socketio.emit('new_message', {
-                'role': conversation['role1'],
-                'content': response1,
-                'round': round_num,
-                'is_role1': True
-            })
-            
-            logger.info(f"角色1({conversation['role1']})發言完成 - 第{round_num}輪")
-            time.sleep(1)
+            if not (round_num == start_round and spoken % 2 == 1):
+                await checkpoint(session_id)
+                await run_dialogue_turn(session_id, round_num, True, wait_for=pending_narration)
+                pending_narration = None
+                await pace(session_id)
             
             # 角色2發言
-            socketio.emit('show_loading', {
-                'role': conversation['role2']
-            })
-            
-            time.sleep(1)  # 模擬思考時間
-            
-            response2 = asyncio.run(conversation_manager.generate_response(
-                session_id, conversation['role2']
-            ))
-            
-            conversation_manager.add_message(
-                session_id, 'dialogue', role=conversation['role2'], content=response2, 
-                round_num=round_num, is_role1=False
-            )
-            
-            socketio.emit('hide_loading')
-            socketio.emit('new_message', {
-                'role': conversation['role2'],
-                'content': response2,
-                'round': round_num,
-                'is_role1': False
-            })
-            
-            logger.info(f"角色2({conversation['role2']})發言完成 - 第{round_num}輪")
-            time.sleep(1)
+            await checkpoint(session_id)
+            await run_dialogue_turn(session_id, round_num, False)
+            await pace(session_id)
 
             # NEW: 旁白發言 (在每輪對話結束後)
             if conversation['narrator_mode']:
-                logger.info(f"開始生成旁白描述 - 第{round_num}輪")
-                socketio.emit('show_loading', {'role': '旁白'})
-                time.sleep(1) # 模擬思考時間
-                
-                narrator_content = asyncio.run(conversation_manager.generate_narrator_description(session_id))
-                
-                conversation_manager.add_message(
-                    session_id, 'narrator', content=narrator_content, round_num=round_num
-                )
-                
-                socketio.emit('hide_loading')
-                socketio.emit('new_narrator_message', { # 發送新的旁白事件
-                    'content': narrator_content
-                })
-                logger.info(f"旁白發言完成 - 第{round_num}輪")
-                time.sleep(1) # 旁白和下一輪開始之間也休息一下
+                await checkpoint(session_id)
+                if PIPELINE_ROUNDS and round_num < conversation['rounds']:
+                    pending_narration = asyncio.ensure_future(
+                        run_narrator_turn(session_id, round_num, show_loading=False)
+                    )
+                else:
+                    await run_narrator_turn(session_id, round_num)
         
         # 對話完成
-        socketio.emit('conversation_finished', {
+        conversation['status'] = 'finished'
+        metrics.inc('conversations_total', status='finished')
+        emit_to_session(session_id, 'conversation_finished', {
             'total_rounds': conversation['rounds']
         })
         
         logger.info(f"對話完成 - Session: {session_id}, 總輪數: {conversation['rounds']}")
         
+    except asyncio.CancelledError:
+        control = conversation_scheduler.controls.get(session_id)
+        reason = control.reason if control else 'cancelled'
+        conversation['status'] = 'cancelled'
+        metrics.inc('conversations_total', status='cancelled')
+        # 重新開始時新的對話沿用同一個房間，不送出舊對話的停止事件
+        if reason != 'restarted':
+            emit_to_session(session_id, 'conversation_stopped', {
+                'reason': reason,
+                'round': conversation['current_round']
+            })
+        logger.info(f"對話已取消（{reason}）- Session: {session_id}, 第{conversation['current_round']}輪")
+        
     except Exception as e:
         logger.error(f"背景對話執行錯誤 - Session: {session_id}, Error: {e}")
-        socketio.emit('error', {'message': '對話過程中發生錯誤'})
+        if session_id in conversation_manager.conversations:
+            conversation_manager.conversations[session_id]['status'] = 'error'
+        metrics.inc('conversations_total', status='error')
+        emit_to_session(session_id, 'error', {'message': '對話過程中發生錯誤'})
+    
+    finally:
+        lease.cancel()
+        if pending_narration is not None:
+            pending_narration.cancel()
+        control = conversation_scheduler.controls.get(session_id)
+        if control is not None and control.reason == 'disconnected':
+            # 斷線逾期：由驅動的 worker 刪除，避免其他 worker 先刪除後又被這裡寫回
+            if conversation_manager.conversations.get(session_id) is conversation:
+                conversation_manager.delete_conversation(session_id)
+                logger.info(f'已清理對話資料 - Session: {session_id}')
+        else:
+            conversation_manager.store.set_control(session_id, cancel=None, paused_by=None)
+            conversation_manager.offload(session_id, conversation)
+            conversation_manager.release(session_id)
+
+# 批次產生：工作檔（輸入與輸出 JSONL）存放目錄，以及每個批次同時進行的劇本數
+BATCH_DIR = os.getenv('BATCH_DIR', 'batch_runs')
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+
+async def run_batch_scenario(session_id):
+    """
+    批次模式跑完一個劇本：與互動模式使用相同的 ConversationManager 提示詞邏輯，
+    但不發送 Socket.IO 事件、不等待呈現間隔、不管線化，任何一次生成失敗都讓整個劇本失敗。
+    """
+    conversation = conversation_manager.conversations[session_id]
+    conversation['status'] = 'running'
+    await conversation_manager.generate_story_outline(session_id, raise_errors=True)
+    
+    for round_num in range(1, conversation['rounds'] + 1):
+        conversation['current_round'] = round_num
+        for is_role1 in (True, False):
+            role = conversation['role1'] if is_role1 else conversation['role2']
+            response = await conversation_manager.generate_response(session_id, role)
+            conversation_manager.add_message(
+                session_id, 'dialogue', role=role, content=response, round_num=round_num, is_role1=is_role1
+            )
+        if conversation['narrator_mode']:
+            narration = await conversation_manager.generate_narrator_description(session_id, round_num=round_num)
+            conversation_manager.add_message(session_id, 'narrator', content=narration, round_num=round_num)
+    
+    conversation['status'] = 'finished'
+
+class BatchJob:
+    """
+    離線批次產生對話：讀入一行一個劇本設定的 JSONL，以固定數量的工作協程消化，
+    每完成一個劇本就附加寫入輸出 JSONL 並 fsync。重新執行同一個工作時略過輸出中已成功的劇本，
+    因此程序中斷後可以接續；失敗的劇本會重跑（同一 id 以最後一筆為準）。
+    模型呼叫一律經過共用的 call_scheduler，受 RPM / TPM 與同時呼叫上限約束。
+    """
+    
+    def __init__(self, input_path, output_path, concurrency=BATCH_CONCURRENCY, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.input_path = input_path
+        self.output_path = output_path
+        self.concurrency = max(1, concurrency)
+        self.status = 'pending' # pending / running / finished / error
+        self.total = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+    
+    def load_scenarios(self):
+        """讀取輸入檔；每行的 id 欄位作為劇本識別，沒有時以行號代替"""
+        scenarios = []
+        with open(self.input_path, encoding='utf-8') as source:
+            for line_number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                scenarios.append((str(data.get('id') or f'line-{line_number}'), data))
+        return scenarios
+    
+    def truncate_torn_tail(self):
+        """中斷時寫到一半的最後一行截掉，輸出檔回到最後一筆完整紀錄"""
+        if not os.path.exists(self.output_path):
+            return
+        with open(self.output_path, 'rb+') as output:
+            size = output.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                output.seek(start)
+                newline = output.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                output.truncate(end)
+                output.flush()
+                os.fsync(output.fileno())
+                logger.warning(f"批次輸出截掉未寫完的最後一行 - Job: {self.job_id}, 位元組: {size - end}")
+    
+    def finished_ids(self):
+        """已在輸出中成功完成的劇本；無法解析的行會被忽略"""
+        latest = {}
+        if os.path.exists(self.output_path):
+            with open(self.output_path, encoding='utf-8') as output:
+                for line in output:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    latest[record['id']] = record['status']
+        return {scenario_id for scenario_id, status in latest.items() if status == 'ok'}
+    
+    async def run_scenario(self, scenario_id, data):
+        session_id = f'batch-{self.job_id}-{scenario_id}'
+        started = time.time()
+        record = {'id': scenario_id, 'scenario': data}
+        try:
+            conversation_manager.create_conversation(
+                session_id, transcript=False, queue_key=f'batch-{self.job_id}', **parse_scenario(data)
+            )
+            await run_batch_scenario(session_id)
+            conversation = conversation_manager.conversations[session_id]
+            record.update({
+                'status': 'ok',
+                'story_outline': conversation['story_outline'],
+                'messages': conversation['messages'].to_list(),
+                'timeline': conversation.get('timeline', [])
+            })
+            self.completed += 1
+        except Exception as e:
+            logger.error(f"批次劇本失敗 - Job: {self.job_id}, Scenario: {scenario_id}, Error: {e}")
+            record.update({'status': 'error', 'error': str(e)})
+            self.failed += 1
+        finally:
+            conversation_manager.delete_conversation(session_id)
+        record['duration_seconds'] = round(time.time() - started, 3)
+        return record
+    
+    async def run(self):
+        self.status = 'running'
+        try:
+            self.truncate_torn_tail()
+            done = self.finished_ids()
+            scenarios = self.load_scenarios()
+            todo = [(scenario_id, data) for scenario_id, data in scenarios if scenario_id not in done]
+            self.total = len(scenarios)
+            self.skipped = self.total - len(todo)
+            pending = iter(todo)
+            logger.info(f"批次工作開始 - Job: {self.job_id}, 劇本: {self.total}, 已完成略過: {self.skipped}")
+            
+            with open(self.output_path, 'a', encoding='utf-8') as output:
+                async def worker():
+                    for scenario_id, data in pending:
+                        record = await self.run_scenario(scenario_id, data)
+                        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                        output.flush()
+                        os.fsync(output.fileno())
+                
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            self.status = 'finished'
+            logger.info(f"批次工作完成 - Job: {self.job_id}, 成功: {self.completed}, 失敗: {self.failed}")
+        except Exception as e:
+            logger.error(f"批次工作錯誤 - Job: {self.job_id}, Error: {e}")
+            self.status = 'error'
+            raise
+    
+    def stats(self):
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'total': self.total,
+            'skipped': self.skipped,
+            'completed': self.completed,
+            'failed': self.failed,
+            'concurrency': self.concurrency
+        }
+
+batch_jobs = {}
+
+def valid_job_id(job_id):
+    """job_id 會用在檔名上，只允許英數字、- 與 _"""
+    return job_id.replace('-', '').replace('_', '').isalnum()
+
+def batch_paths(job_id):
+    return os.path.join(BATCH_DIR, f'{job_id}.input.jsonl'), os.path.join(BATCH_DIR, f'{job_id}.output.jsonl')
+
+@app.route('/api/batch', methods=['POST'])
+def start_batch():
+    """
+    建立或接續批次工作。請求本文為 JSONL 劇本（每行一個，欄位同 /api/start-conversation，可加 id）；
+    帶入既有的 job_id 且不附本文時，以先前保存的輸入接續執行。
+    """
+    job_id = request.args.get('job_id') or uuid.uuid4().hex
+    if not valid_job_id(job_id):
+        return jsonify({'error': 'job_id 只能包含英數字、- 與 _'}), 400
+    job = batch_jobs.get(job_id)
+    if job is not None and job.status == 'running':
+        return jsonify({'error': '批次工作執行中'}), 409
+    
+    input_path, output_path = batch_paths(job_id)
+    body = request.get_data(as_text=True)
+    if body.strip():
+        try:
+            for line in body.splitlines():
+                if line.strip():
+                    parse_scenario(json.loads(line))
+        except (ValueError, AttributeError) as e:
+            return jsonify({'error': f'劇本格式錯誤：{e}'}), 400
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        with open(input_path, 'w', encoding='utf-8') as source:
+            source.write(body)
+    elif not os.path.exists(input_path):
+        return jsonify({'error': '請提供 JSONL 劇本'}), 400
+    
+    concurrency = request.args.get('concurrency', BATCH_CONCURRENCY, type=int)
+    job = batch_jobs[job_id] = BatchJob(input_path, output_path, concurrency, job_id)
+    conversation_scheduler.spawn(job.run())
+    return jsonify({'success': True, 'job_id': job_id})
+
+@app.route('/api/batch/<job_id>', methods=['GET'])
+def get_batch_status(job_id):
+    """獲取批次工作進度的 API"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '找不到批次工作'}), 404
+    return jsonify({'success': True, 'batch': job.stats()})
+
+@app.route('/api/batch/<job_id>/results', methods=['GET'])
+def get_batch_results(job_id):
+    """以串流方式回傳目前已完成的對話紀錄（JSONL）"""
+    _, output_path = batch_paths(job_id)
+    if not valid_job_id(job_id) or not os.path.exists(output_path):
+        return jsonify({'error': '找不到批次結果'}), 404
+    
+    def generate():
+        with open(output_path, encoding='utf-8') as output:
+            for line in output:
+                if line.endswith('\n'):
+                    yield line
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """獲取模型回應快取命中統計的 API"""
+    return jsonify({
+        'success': True,
+        'cache': conversation_manager.response_cache.stats()
+    })
+
+@app.route('/api/memory-stats', methods=['GET'])
+def get_memory_stats():
+    """獲取會話記憶體使用統計的 API"""
+    return jsonify({
+        'success': True,
+        'memory': conversation_manager.memory_stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 格式的指標：各階段延遲直方圖、權杖與錯誤計數、會話與呼叫量表"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/conversation/<session_id>', methods=['GET'])
 def get_conversation_info(session_id):
-    """獲取對話資訊的 API"""
+    """
+    獲取對話資訊的 API。
+    帶 ?since=<seq> 時只回傳序號大於 seq 的訊息，且不附時間軸（時間軸會隨輪數增長，增量輪詢不需要）；
+    內容沒有變化時依 If-None-Match 回應 304。
+    """
     try:
         conversation = conversation_manager.get_conversation(session_id)
         if not conversation:
             return jsonify({'error': '找不到對話記錄'}), 404
         
+        since = request.args.get('since', type=int)
+        messages = conversation['messages']
+        timeline = conversation.get('timeline', [])
+        # 以建立時間區分同一個會話 ID 重新開始後的不同對話，其餘部分是進度計數
+        etag = '-'.join(str(part) for part in (
+            int(conversation.get('created_at', 0) * 1000), len(messages), conversation['status'],
+            conversation.get('paused') or '', conversation['current_round'], int(bool(conversation['story_outline'])),
+            len(timeline) if since is None else 'delta', since
+        ))
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        info = {
+            'role1': conversation['role1'],
+            'role2': conversation['role2'],
+            'role1_description': conversation['role1_description'],
+            'role2_description': conversation['role2_description'],
+            'topic': conversation['topic'],
+            'word_limit': conversation['word_limit'],
+            'rounds': conversation['rounds'],
+            'current_round': conversation['current_round'],
+            'story_outline': conversation['story_outline'],
+            'narrator_mode': conversation['narrator_mode'], # NEW: 返回旁白模式狀態
+            'status': conversation['status'],
+            'paused': conversation.get('paused'),
+            'forked_from': conversation.get('forked_from'), # 分支來源會話與分支輪數
+            'last_seq': len(messages),
+            'messages': messages.since(since) if since is not None else messages.to_list()
+        }
+        if since is None:
+            info['timeline'] = timeline # 各階段的開始秒數、耗時與排隊／模型時間
+        response = jsonify({'success': True, 'conversation': info})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+        
+    except Exception as e:
+        logger.error(f"獲取對話資訊錯誤: {e}")
+        return jsonify({'error': '獲取對話資訊失敗'}), 500
+
+# 一次分支最多可展開的會話數
+MAX_FORK_BRANCHES = int(os.getenv('MAX_FORK_BRANCHES', 8))
+
+def parse_fork_overrides(data):
+    """分支時可改寫的設定（欄位名稱同 /api/start-conversation）；格式錯誤時拋出 ValueError"""
+    overrides = {}
+    for field, key in (('role1Description', 'role1_description'), ('role2Description', 'role2_description'), ('topic', 'topic')):
+        if field in data:
+            overrides[key] = str(data[field]).strip()
+    if overrides.get('topic') == '':
+        raise ValueError('話題不能為空')
+    try:
+        for field, key in (('wordLimit', 'word_limit'), ('rounds', 'rounds')):
+            if field in data:
+                overrides[key] = int(data[field])
+    except (TypeError, ValueError):
+        raise ValueError('字數限制與輪數必須是整數')
+    if 'narratorMode' in data:
+        overrides['narrator_mode'] = bool(data['narratorMode'])
+    return overrides
+
+def format_transcript_line(message):
+    """純文字匯出的一行：角色發言或旁白"""
+    if message['type'] == 'dialogue':
+        return f"[第{message['round']}輪] {message['role']}：{message['content']}\n"
+    return f"[第{message['round']}輪] （旁白）{message['content']}\n"
+
+@app.route('/api/conversation/<session_id>/export', methods=['GET'])
+def export_conversation(session_id):
+    """
+    以串流匯出完整逐字稿：format=ndjson（預設，第一行為會話設定，之後每行一則訊息）或 text。
+    已卸載的會話直接從逐字稿儲存逐批讀出，不會整份載入記憶體。
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'text'):
+        return jsonify({'error': '不支援的匯出格式'}), 400
+    
+    conversation = conversation_manager.get_conversation(session_id, load_transcript=False)
+    transcripts = conversation_manager.transcripts
+    if conversation is not None:
+        meta = {key: value for key, value in conversation.items() if key not in TranscriptStore.TRANSIENT_KEYS}
+        messages = (message.to_dict() for message in conversation['messages'])
+    else:
+        meta = transcripts.load_meta(session_id) if transcripts is not None else None
+        if meta is None:
+            return jsonify({'error': '找不到對話記錄'}), 404
+        messages = transcripts.iter_messages(session_id)
+    
+    def generate():
+        if export_format == 'ndjson':
+            yield json.dumps({'type': 'conversation', 'session_id': session_id, **meta}, ensure_ascii=False) + '\n'
+            for message in messages:
+                yield json.dumps(message, ensure_ascii=False) + '\n'
+        else:
+            yield f"{meta['role1']} × {meta['role2']}：{meta['topic']}\n\n"
+            if meta.get('story_outline'):
+                yield f"故事大綱：{meta['story_outline']}\n\n"
+            for message in messages:
+                yield format_transcript_line(message)
+    
+    extension = 'ndjson' if export_format == 'ndjson' else 'txt'
+    mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'text/plain; charset=utf-8'
+    return Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{session_id}.{extension}"'
+    })
+
+@app.route('/api/conversation/<session_id>/fork', methods=['POST'])
+def fork_conversation(session_id):
+    """
+    從既有會話的第 round 輪結束處分支出新會話，只生成分支點之後的輪次。
+    JSON：round（保留的輪數）、可改寫的設定（同 /api/start-conversation），或以 branches 陣列一次展開多個分支，
+    每個分支各自的設定覆蓋外層設定。新會話一律以隨機 ID 建立；只有單一分支時可帶 socketId（須連線在本程序），
+    該連線直接成為新會話的擁有者，其餘由客戶端以 join_conversation 帶入對應的 resume_tokens 加入。
+    """
+    try:
+        data = request.json or {}
+        try:
+            round_num = int(data.get('round'))
+        except (TypeError, ValueError):
+            return jsonify({'error': '分支輪數必須是整數'}), 400
+        if data.get('socketId') and not is_local_socket(data['socketId']):
+            return jsonify({'error': '無效的連線 ID'}), 400
+        
+        source = conversation_manager.get_conversation(session_id)
+        if source is None:
+            return jsonify({'error': '找不到對話記錄'}), 404
+        
+        # 先檢查分支點與所有分支的設定，避免只建立了部分分支
+        try:
+            if round_num < 0 or round_num > len(source['conversation_history']) // 2:
+                raise ValueError('來源對話尚未進行到該輪')
+            common = parse_fork_overrides(data)
+            branches = data.get('branches') or [{}]
+            if not isinstance(branches, list) or not all(isinstance(branch, dict) for branch in branches):
+                raise ValueError('branches 必須是設定物件的陣列')
+            if len(branches) > MAX_FORK_BRANCHES:
+                raise ValueError(f'一次最多分支 {MAX_FORK_BRANCHES} 個')
+            branch_overrides = [dict(common, **parse_fork_overrides(branch)) for branch in branches]
+            if any(overrides.get('rounds', source['rounds']) <= round_num for overrides in branch_overrides):
+                raise ValueError('輪數必須大於分支輪數')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        owner = data.get('socketId') if len(branch_overrides) == 1 else None
+        session_ids = []
+        for overrides in branch_overrides:
+            branch_id = uuid.uuid4().hex
+            try:
+                conversation_manager.fork_conversation(session_id, branch_id, round_num, **overrides)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            # 沿用同一個 socketId 重新分支時，先取消該客戶端原本的對話
+            if owner:
+                release_previous(owner)
+                take_ownership(owner, branch_id)
+            conversation_scheduler.submit(branch_id, run_conversation_background)
+            session_ids.append(branch_id)
+        
+        logger.info(f"對話分支 - Session: {session_id}, 第{round_num}輪, 分支數: {len(session_ids)}")
         return jsonify({
             'success': True,
-            'conversation': {
-                'role1': conversation['role1'],
-                'role2': conversation['role2'],
-                'role1_description': conversation['role1_description'],
-                'role2_description': conversation['role2_description'],
-                'topic': conversation['topic'],
-                'word_limit': conversation['word_limit'],
-                'rounds': conversation['rounds'],
-                'current_round': conversation['current_round'],
-                'story_outline': conversation['story_outline'],
-                'narrator_mode': conversation['narrator_mode'], # NEW: 返回旁白模式狀態
-                'messages': conversation['messages']
-            }
+            'session_ids': session_ids,
+            'resume_tokens': [resume_token(branch_id) for branch_id in session_ids],
+            'round': round_num,
+            'message': '分支對話已開始'
         })
         
     except Exception as e:
-        logger.error(f"獲取對話資訊錯誤: {e}")
-        return jsonify({'error': '獲取對話資訊失敗'}), 500
+        logger.error(f"分支對話時發生錯誤: {e}")
+        return jsonify({'error': '分支對話失敗'}), 500
 
 @socketio.on('connect')
 def handle_connect():
     """WebSocket 連接處理"""
     logger.info(f'客戶端已連接 - Session: {request.sid}')
+    metrics.inc('connected_sockets')
     emit('connected', {'message': '連接成功'})
 
+@socketio.on('join_conversation')
+def handle_join_conversation(data):
+    """
+    以 resume_token 加入會話房間並成為擁有者（例如重新連線後，或以 HTTP 開始、分支的會話）。
+    新的連線直接取代原本的擁有者，不必等伺服器察覺舊連線斷線；之後舊連線的斷線不會再暫停或清除這個會話。
+    帶入 last_seq 時視為重新連線的接續握手：先加入房間再取快照，回應（ack）只附上序號大於 last_seq 的訊息，
+    之後的新訊息照常由房間送達，重複的部分由客戶端依序號略過。
+    """
+    session_id = data.get('session_id')
+    if not session_id:
+        return {'success': False, 'error': '缺少會話 ID'}
+    if not valid_resume_token(session_id, data.get('resume_token')):
+        return {'success': False, 'error': '續接權杖無效'}
+    
+    take_ownership(request.sid, session_id)
+    logger.info(f'客戶端加入對話房間 - Socket: {request.sid}, Session: {session_id}')
+    
+    conversation = conversation_manager.get_conversation(session_id)
+    if conversation is None:
+        return {'success': False, 'error': '找不到對話記錄'}
+    conversation_manager.reattach(session_id)
+    conversation_scheduler.resume(session_id, paused_by='detached')
+    
+    # 原本驅動的 worker 已離線（租約過期）時由本 worker 接手；租約仍有效則 claim 會直接略過
+    if conversation.get('status') == 'running' and session_id not in conversation_scheduler.tasks:
+        conversation_scheduler.submit(session_id, run_conversation_background)
+    
+    try:
+        last_seq = int(data['last_seq'])
+    except (KeyError, TypeError, ValueError):
+        return {'success': True}
+    return {
+        'success': True,
+        'status': conversation['status'],
+        'rounds': conversation['rounds'],
+        'current_round': conversation['current_round'],
+        'story_outline': conversation['story_outline'],
+        'paused': conversation.get('paused'),
+        'last_seq': len(conversation['messages']),
+        'messages': conversation['messages'].since(last_seq)
+    }
+
+async def expire_detached(session_id, detached_at, owner):
+    """斷線寬限期過後仍沒有客戶端重新加入（擁有者仍是斷線的連線）時才清理對話資料"""
+    await asyncio.sleep(RESUME_GRACE_SECONDS)
+    if conversation_manager.detached_at(session_id) != detached_at or session_owner(session_id) != owner:
+        return
+    # 仍在執行的會話（不論由哪個 worker 驅動）取消後由驅動端刪除，其餘直接刪除
+    if not conversation_scheduler.cancel(session_id, 'disconnected'):
+        conversation_manager.delete_conversation(session_id)
+        logger.info(f'已清理對話資料 - Session: {session_id}')
+
 @socketio.on('disconnect')
 def handle_disconnect():
     """WebSocket 斷線處理"""
     logger.info(f'客戶端已斷線 - Session: {request.sid}')
+    metrics.inc('connected_sockets', -1)
+    
+    # 會話已由新的連線接手（重新連線比舊連線的斷線先到）時不做任何處理
+    session_id = owned_sessions.pop(request.sid, None)
+    if session_id is None or session_owner(session_id) != request.sid:
+        return
     
-    # 清理對話資料
-    if request.sid in conversation_manager.conversations:
-        del conversation_manager.conversations[request.sid]
-        logger.info(f'已清理對話資料 - Session: {request.sid}')
+    # 清理對話資料；設定寬限期時先保留並暫停（不再開始新的回合），讓客戶端重新連線後接續，過期才取消
+    if RESUME_GRACE_SECONDS <= 0:
+        if conversation_scheduler.cancel(session_id, 'disconnected'):
+            return
+        if conversation_manager.get_conversation(session_id, load_transcript=False) is not None:
+            conversation_manager.delete_conversation(session_id)
+            logger.info(f'已清理對話資料 - Session: {session_id}')
+        return
+    detached_at = conversation_manager.detach(session_id)
+    if detached_at is None:
+        return
+    conversation_scheduler.pause(session_id, 'detached')
+    if session_owner(session_id) != request.sid:
+        # 標記期間新的連線已接手：撤銷這次的斷線標記與暫停
+        conversation_manager.reattach(session_id)
+        conversation_scheduler.resume(session_id, paused_by='detached')
+        return
+    conversation_scheduler.spawn(expire_detached(session_id, detached_at, request.sid))
+
+def controlled_session(data):
+    """控制事件的目標會話：預設為本連線擁有的會話；只有目前的擁有者可以控制，否則回傳 None"""
+    session_id = (data or {}).get('session_id') or owned_sessions.get(request.sid)
+    if session_id is None or session_owner(session_id) != request.sid:
+        return None
+    return session_id
+
+@socketio.on('stop_conversation')
+def handle_stop_conversation(data=None):
+    """停止執行中的對話：進行中的模型呼叫盡可能中止，已產生的訊息保留"""
+    session_id = controlled_session(data)
+    if session_id is None:
+        return {'success': False, 'error': '沒有權限控制這個對話'}
+    if not conversation_scheduler.cancel(session_id, 'stopped'):
+        return {'success': False, 'error': '沒有執行中的對話'}
+    return {'success': True}
+
+@socketio.on('pause_conversation')
+def handle_pause_conversation(data=None):
+    """暫停對話：目前的回合完成後不再開始新的回合，狀態保留到繼續為止"""
+    session_id = controlled_session(data)
+    if session_id is None:
+        return {'success': False, 'error': '沒有權限控制這個對話'}
+    if not conversation_scheduler.pause(session_id):
+        return {'success': False, 'error': '沒有執行中的對話'}
+    return {'success': True}
+
+@socketio.on('resume_conversation')
+def handle_resume_conversation(data=None):
+    """繼續已暫停的對話"""
+    session_id = controlled_session(data)
+    if session_id is None:
+        return {'success': False, 'error': '沒有權限控制這個對話'}
+    if not conversation_scheduler.resume(session_id):
+        return {'success': False, 'error': '對話沒有暫停'}
+    return {'success': True}
 
 @socketio.on('get_story_outline')
 def handle_get_story_outline(data):
     """處理獲取故事大綱的請求"""
     try:
-        session_id = data.get('session_id', request.sid)
+        session_id = data.get('session_id') or owned_sessions.get(request.sid)
         conversation = conversation_manager.get_conversation(session_id)
         
         if conversation and conversation.get('story_outline'):
@@ -472,6 +3170,66 @@ def internal_error(error):
     logger.error(f"伺服器內部錯誤: {error}")
     return jsonify({'error': '伺服器內部錯誤'}), 500
 
+@app.before_request
+def record_first_request():
+    """記錄開機後第一個請求抵達的時間"""
+    if startup_timings['first_request_seconds'] is None:
+        startup_timings['first_request_seconds'] = round(time.perf_counter() - BOOT_STARTED, 3)
+        g.first_request_started = time.perf_counter()
+
+@app.after_request
+def report_first_request(response):
+    """第一個請求完成後輸出一次啟動計時報告"""
+    started = g.pop('first_request_started', None)
+    if started is not None:
+        startup_timings['first_request_duration'] = round(time.perf_counter() - started, 3)
+        logger.info(f"啟動計時：{startup_timings}")
+    return response
+
+@app.route('/api/health', methods=['GET'])
+def get_health():
+    """存活檢查：能回應即代表頁面可以提供；另附模型狀態與啟動計時"""
+    return jsonify({
+        'success': True,
+        'serving': True,
+        'model': {'backend': MODEL_BACKEND, **model_status},
+        'startup': startup_timings
+    })
+
+@app.route('/api/ready', methods=['GET'])
+def get_readiness():
+    """就緒檢查：模型已載入（預熱完成或已成功呼叫過）才回應 200，否則 503"""
+    ready = model_status['state'] == 'ready'
+    return jsonify({
+        'success': ready,
+        'model': {'backend': MODEL_BACKEND, **model_status}
+    }), 200 if ready else 503
+
+def warm_up_model():
+    """
+    背景預熱：匯入 SDK、建立各路由的模型物件（與實際呼叫共用 conversation_manager 快取的同一個物件），
+    再以不消耗生成配額的 count_tokens 呼叫建立該物件的 API 用戶端與連線，第一次生成不必再付這段成本
+    """
+    time.sleep(MODEL_WARMUP_DELAY_SECONDS)
+    started = time.perf_counter()
+    model_status.update(state='warming', error=None)
+    try:
+        for model_name in {MODEL_NAME, *MODEL_ROUTES.values()}:
+            model = conversation_manager.get_model(model_name)
+            if hasattr(model, 'count_tokens'): # 假模型沒有連線需要建立
+                run_blocking(model.count_tokens, 'ping')
+        model_status.update(state='ready', error=None)
+        logger.info(f"模型預熱完成，耗時 {time.perf_counter() - started:.2f} 秒")
+    except Exception as e:
+        model_status.update(state='error', error=str(e))
+        logger.warning(f"模型預熱失敗: {e}")
+    startup_timings['warmup_seconds'] = round(time.perf_counter() - started, 3)
+
+if MODEL_WARMUP and model_status['state'] == 'cold':
+    Thread(target=warm_up_model, name='model-warmup', daemon=True).start()
+
+startup_timings['module_ready_seconds'] = round(time.perf_counter() - BOOT_STARTED, 3)
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     logger.info(f"啟動伺服器，Port: {port}")
@@ -0,0 +1,35 @@
+"""
+批次產生對話的命令列工具
+
+讀入一行一個劇本設定的 JSONL（欄位同 /api/start-conversation：role1、role2、role1Description、
+role2Description、topic、wordLimit、rounds、narratorMode，可另加 id），在本程序內以有限並行數跑完，
+每完成一個劇本就把完整對話紀錄附加寫入輸出 JSONL。中斷後以相同參數重新執行即可接續，已成功的劇本會略過。
+
+    python batch.py scenarios.jsonl transcripts.jsonl --concurrency 8
+
+與伺服器共用 app.py 的 ConversationManager 與模型呼叫排程（MAX_INFLIGHT_MODEL_CALLS、MODEL_RPM_LIMIT、
+MODEL_TPM_LIMIT 等環境變數同樣有效）；不需要啟動伺服器。
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AI 角色對話系統批次產生工具')
+    parser.add_argument('input', help='劇本設定 JSONL')
+    parser.add_argument('output', help='對話紀錄輸出 JSONL（附加寫入，可接續）')
+    parser.add_argument('--concurrency', type=int, default=app.BATCH_CONCURRENCY, help='同時進行的劇本數')
+    args = parser.parse_args()
+
+    job = app.BatchJob(args.input, args.output, args.concurrency, job_id='cli')
+    asyncio.run(job.run())
+    print(json.dumps(job.stats(), ensure_ascii=False))
+    return 0 if job.failed == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+壓力／延遲測試工具
+
+同時開啟 N 個對話會話，經由 Socket.IO 的 start_conversation 與後續事件驅動完整流程，回報：
+大綱完成時間、第一則訊息時間、每輪延遲百分位數、每秒完成會話數、伺服器 worker 的 CPU 與 RSS，
+以及測試期間 /api/health 的回應延遲（模型呼叫阻塞 worker 時會明顯變慢，假模型的延遲與 SDK 一樣是真正的阻塞）。
+
+預設搭配離線假模型（MODEL_BACKEND=fake），不需要 GEMINI_API_KEY：
+    python benchmark.py --spawn --sessions 50 --rounds 4
+對已啟動的伺服器測試：
+    python benchmark.py --url http://localhost:5000 --sessions 20
+
+需要 python-socketio 的客戶端（Flask-SocketIO 已附帶）、websocket-client 與 requests（pip install -r requirements-dev.txt）；
+與網頁相同只使用 WebSocket 傳輸，多 worker 時不必依賴負載平衡器的黏性工作階段。--spawn 以 gunicorn eventlet worker 啟動，與部署設定相同。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+import socketio
+
+
+def percentile(values, pct):
+    """以最近秩法計算百分位數"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    """整理成 p50 / p90 / p99 / 最大值（秒）"""
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50), 4),
+        'p90': round(percentile(values, 90), 4),
+        'p99': round(percentile(values, 99), 4),
+        'max': round(max(values), 4)
+    }
+
+
+def worker_pids(master_pid):
+    """gunicorn master 底下的 worker 程序"""
+    try:
+        with open(f'/proc/{master_pid}/task/{master_pid}/children') as children:
+            return [int(pid) for pid in children.read().split()]
+    except (OSError, ValueError):
+        return []
+
+
+def process_usage(pids):
+    """讀取 /proc 取得各程序累計 CPU 秒數與目前 RSS（位元組）的總和"""
+    cpu_seconds = 0.0
+    rss_bytes = 0
+    try:
+        for pid in pids:
+            with open(f'/proc/{pid}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            cpu_seconds += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            rss_bytes += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        return cpu_seconds, rss_bytes
+    except (OSError, IndexError, ValueError):
+        return None, None
+
+
+class SessionRun:
+    """單一會話的客戶端：記錄各事件相對於開始請求的時間"""
+
+    def __init__(self, base_url, config, timeout):
+        self.base_url = base_url
+        self.config = config
+        self.timeout = timeout
+        self.client = socketio.Client(reconnection=False)
+        self.done = threading.Event()
+        self.started_at = None
+        self.first_outline_chunk = None
+        self.outline_at = None
+        self.first_message_at = None
+        self.turn_times = []
+        self.finished_at = None
+        self.error = None
+
+        self.client.on('message_chunk', self.on_chunk)
+        self.client.on('message_done', self.on_turn_done)
+        self.client.on('new_message', self.on_turn_done)
+        self.client.on('new_narrator_message', self.on_turn_done)
+        self.client.on('story_outline_generated', self.on_outline)
+        self.client.on('conversation_finished', self.on_finished)
+        self.client.on('error', self.on_error)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def on_chunk(self, data):
+        if data.get('kind') == 'outline':
+            if self.first_outline_chunk is None:
+                self.first_outline_chunk = self.elapsed()
+        elif self.first_message_at is None:
+            self.first_message_at = self.elapsed()
+
+    def on_outline(self, data):
+        self.outline_at = self.elapsed()
+
+    def on_turn_done(self, data):
+        now = self.elapsed()
+        if self.first_message_at is None:
+            self.first_message_at = now
+        self.turn_times.append(now)
+
+    def on_finished(self, data):
+        self.finished_at = self.elapsed()
+        self.done.set()
+
+    def on_error(self, data):
+        self.error = data.get('message') if isinstance(data, dict) else str(data)
+        self.done.set()
+
+    def run(self):
+        try:
+            self.client.connect(self.base_url, transports=['websocket'])
+            self.started_at = time.perf_counter()
+            # 與網頁相同，經由 Socket.IO 開始對話，本連線由伺服器直接加入會話房間
+            result = self.client.call('start_conversation', self.config, timeout=self.timeout)
+            if not result or not result.get('success'):
+                raise RuntimeError((result or {}).get('error', '開始對話失敗'))
+            if not self.done.wait(self.timeout):
+                self.error = 'timeout'
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            try:
+                self.client.disconnect()
+            except Exception:
+                pass
+
+    def round_latencies(self):
+        """每輪耗時：以每輪最後一則訊息完成的時間差計算"""
+        per_round = 3 if self.config.get('narratorMode') else 2
+        ends = [self.outline_at or 0.0] + self.turn_times[per_round - 1::per_round]
+        return [later - earlier for earlier, later in zip(ends, ends[1:])]
+
+
+def spawn_server(port, workers, env_overrides):
+    """以假模型、與正式環境相同的 gunicorn eventlet worker 啟動本機伺服器，等到首頁可以回應為止"""
+    env = dict(os.environ, MODEL_BACKEND='fake', **env_overrides)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--worker-class', 'eventlet', '-w', str(workers),
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(base_url + '/', timeout=1).ok:
+                return server, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('伺服器啟動逾時')
+
+
+def run_benchmark(base_url, sessions, concurrency, config, timeout, server_pids=None):
+    runs = [SessionRun(base_url, config, timeout) for _ in range(sessions)]
+    cpu_before, _ = process_usage(server_pids) if server_pids else (None, None)
+    peak_rss = 0
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        nonlocal peak_rss
+        while not stop_sampling.is_set():
+            _, rss = process_usage(server_pids)
+            peak_rss = max(peak_rss, rss or 0)
+            stop_sampling.wait(0.2)
+
+    sampler = None
+    if server_pids:
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+    # 與會話無關的請求：模型呼叫進行中仍應立即回應
+    health_latencies = []
+
+    def probe_health():
+        while not stop_sampling.is_set():
+            sent = time.perf_counter()
+            try:
+                requests.get(f'{base_url}/api/health', timeout=timeout)
+                health_latencies.append(time.perf_counter() - sent)
+            except requests.RequestException:
+                pass
+            stop_sampling.wait(0.2)
+
+    prober = threading.Thread(target=probe_health, daemon=True)
+    prober.start()
+
+    started = time.perf_counter()
+    slots = threading.Semaphore(concurrency)
+
+    def worker(run):
+        with slots:
+            run.run()
+
+    threads = [threading.Thread(target=worker, args=(run,)) for run in runs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    stop_sampling.set()
+    prober.join()
+    if sampler:
+        sampler.join()
+
+    completed = [run for run in runs if run.finished_at is not None]
+    report = {
+        'sessions': sessions,
+        'concurrency': concurrency,
+        'completed': len(completed),
+        'failed': sessions - len(completed),
+        'errors': sorted({run.error for run in runs if run.error}),
+        'wall_seconds': round(wall, 3),
+        'sessions_per_second': round(len(completed) / wall, 3) if wall else None,
+        'time_to_first_outline_token': summarize([r.first_outline_chunk for r in runs if r.first_outline_chunk is not None]),
+        'time_to_outline': summarize([r.outline_at for r in runs if r.outline_at is not None]),
+        'time_to_first_message': summarize([r.first_message_at for r in runs if r.first_message_at is not None]),
+        'round_latency': summarize([latency for r in completed for latency in r.round_latencies()]),
+        'session_duration': summarize([r.finished_at for r in completed]),
+        'health_latency': summarize(health_latencies)
+    }
+
+    if server_pids:
+        cpu_after, rss = process_usage(server_pids)
+        if cpu_before is not None and cpu_after is not None:
+            report['worker_cpu_seconds'] = round(cpu_after - cpu_before, 3)
+            report['worker_cpu_utilization'] = round((cpu_after - cpu_before) / wall, 3)
+        report['worker_rss_bytes'] = rss
+        report['worker_peak_rss_bytes'] = peak_rss
+    else:
+        try:
+            memory = requests.get(f'{base_url}/api/memory-stats', timeout=5).json().get('memory', {})
+            report['worker_rss_bytes'] = memory.get('rss_bytes')
+        except (requests.RequestException, ValueError):
+            pass
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AI 角色對話系統壓力／延遲測試')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='伺服器網址（未使用 --spawn 時）')
+    parser.add_argument('--spawn', action='store_true', help='以假模型自動啟動本機伺服器')
+    parser.add_argument('--port', type=int, default=5055, help='--spawn 時使用的埠號')
+    parser.add_argument('--workers', type=int, default=1, help='--spawn 時的 gunicorn worker 數')
+    parser.add_argument('--sessions', type=int, default=20, help='總會話數')
+    parser.add_argument('--concurrency', type=int, default=None, help='同時進行的會話數（預設等於總會話數）')
+    parser.add_argument('--rounds', type=int, default=4, help='每個會話的輪數')
+    parser.add_argument('--word-limit', type=int, default=60)
+    parser.add_argument('--narrator', action='store_true', help='啟用旁白模式')
+    parser.add_argument('--timeout', type=float, default=300, help='單一會話逾時秒數')
+    parser.add_argument('--fake-latency', default=None, help='覆寫 FAKE_MODEL_LATENCY，例如 uniform:0.2,0.6')
+    parser.add_argument('--fake-error-rate', default=None, help='覆寫 FAKE_MODEL_ERROR_RATE')
+    parser.add_argument('--output', default=None, help='把結果以 JSON 寫入檔案')
+    args = parser.parse_args()
+
+    config = {
+        'role1': '野比．大雄',
+        'role2': '哆啦A夢',
+        'role1Description': '聰明但懶惰的小學生',
+        'role2Description': '來自22世紀的機器貓',
+        'topic': '在人工智慧創新競賽中得獎',
+        'wordLimit': args.word_limit,
+        'rounds': args.rounds,
+        'narratorMode': args.narrator
+    }
+
+    server = None
+    base_url = args.url.rstrip('/')
+    if args.spawn:
+        overrides = {}
+        if args.fake_latency:
+            overrides['FAKE_MODEL_LATENCY'] = args.fake_latency
+        if args.fake_error_rate:
+            overrides['FAKE_MODEL_ERROR_RATE'] = args.fake_error_rate
+        server, base_url = spawn_server(args.port, args.workers, overrides)
+
+    try:
+        report = run_benchmark(
+            base_url, args.sessions, args.concurrency or args.sessions, config, args.timeout,
+            server_pids=worker_pids(server.pid) if server else None
+        )
+    finally:
+        if server:
+            server.terminate()
+            server.wait(10)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            output.write(text)
+    return 0 if report['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
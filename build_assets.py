@@ -0,0 +1,116 @@
+"""
+靜態圖片建置工具
+
+把 static/image 下的角色頭像與圖示轉成縮圖尺寸的 AVIF / WebP / PNG 變體，
+以內容雜湊命名輸出到 static/dist，並寫出 manifest.json 供 app.py 產生 srcset。
+原始圖片動輒數百 KB，但頁面上只以 24~40px 顯示，行動裝置首次載入主要花在這裡。
+
+    python build_assets.py
+
+需要 Pillow（11.2 以上內建 AVIF 支援；不支援時自動略過 AVIF）。Docker 映像建置時會執行一次。
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+
+from PIL import Image, features
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BASE_DIR, 'static')
+OUTPUT_DIR = os.path.join(BASE_DIR, 'static', 'dist')
+
+# 各目錄要輸出的寬度（像素）：對應頁面上的顯示尺寸與 2x / 3x 高解析度螢幕
+VARIANT_WIDTHS = {
+    'image/role': (40, 80, 120),
+    'image/icon': (30, 60, 90)
+}
+
+# 輸出格式與編碼參數；順序即 <picture> 中 <source> 的優先順序
+FORMATS = {
+    'avif': {'format': 'AVIF', 'quality': 55},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'png': {'format': 'PNG', 'optimize': True}
+}
+
+
+def resize(image, width):
+    """等比例縮小到指定寬度（不放大）"""
+    if image.width <= width:
+        return image
+    height = round(image.height * width / image.width)
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def encode(image, options):
+    buffer = io.BytesIO()
+    image.save(buffer, **options)
+    return buffer.getvalue()
+
+
+def write_hashed(data, directory, stem, width, ext):
+    """以內容雜湊命名寫出檔案，回傳相對於 OUTPUT_DIR 的路徑；內容相同時檔名不變，可長期快取"""
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    name = f"{stem}-{width}w.{digest}.{ext}"
+    os.makedirs(os.path.join(OUTPUT_DIR, directory), exist_ok=True)
+    path = os.path.join(OUTPUT_DIR, directory, name)
+    if not os.path.exists(path):
+        with open(path, 'wb') as output:
+            output.write(data)
+    return f"{directory}/{name}"
+
+
+def remove_stale(manifest):
+    """刪除不再被 manifest 引用的舊雜湊檔案"""
+    current = {path for entry in manifest.values() for ext in FORMATS if ext in entry for path, _ in entry[ext]}
+    for directory in VARIANT_WIDTHS:
+        output_dir = os.path.join(OUTPUT_DIR, directory)
+        if not os.path.isdir(output_dir):
+            continue
+        for filename in os.listdir(output_dir):
+            if f"{directory}/{filename}" not in current:
+                os.remove(os.path.join(output_dir, filename))
+
+
+def build(formats):
+    manifest = {}
+    for directory, widths in VARIANT_WIDTHS.items():
+        source_dir = os.path.join(SOURCE_DIR, directory)
+        for filename in sorted(os.listdir(source_dir)):
+            if not filename.lower().endswith('.png'):
+                continue
+            stem = os.path.splitext(filename)[0]
+            with Image.open(os.path.join(source_dir, filename)) as source:
+                image = source.convert('RGBA')
+
+            entry = {'width': image.width, 'height': image.height}
+            for ext in formats:
+                entry[ext] = []
+                for width in widths:
+                    data = encode(resize(image, width), FORMATS[ext])
+                    entry[ext].append([write_hashed(data, directory, stem, width, ext), min(width, image.width)])
+            manifest[f"/static/{directory}/{filename}"] = entry
+            print(f"{directory}/{filename} -> {len(widths) * len(formats)} 個變體")
+
+    with open(os.path.join(OUTPUT_DIR, 'manifest.json'), 'w', encoding='utf-8') as output:
+        json.dump({'formats': list(formats), 'images': manifest}, output, ensure_ascii=False)
+    remove_stale(manifest)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='建置縮圖與多格式圖片變體')
+    parser.add_argument('--no-avif', action='store_true', help='不輸出 AVIF（編碼較慢）')
+    args = parser.parse_args()
+
+    formats = list(FORMATS)
+    if args.no_avif or not features.check('avif'):
+        formats.remove('avif')
+    build(formats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
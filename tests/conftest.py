@@ -0,0 +1,10 @@
+import os
+import sys
+
+# 測試一律使用離線假模型與單一程序記憶體儲存，不需要 API 金鑰；必須在匯入 app 之前設定
+os.environ['MODEL_BACKEND'] = 'fake'
+os.environ['MODEL_WARMUP'] = 'false'
+os.environ['SESSION_STORE_URL'] = ''
+os.environ['TRANSCRIPT_DB'] = ''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+"""
+重新連線的續接行為：會話擁有權以 resume_token 認定，新的連線直接取代舊連線，
+舊連線較晚送達的斷線不會暫停、標記或清除已被接手的會話。
+"""
+import pytest
+
+import app
+
+
+SCENARIO = {'role1': 'A', 'role2': 'B', 'topic': '主題', 'wordLimit': 50, 'rounds': 50}
+
+
+@pytest.fixture
+def started():
+    """以 Socket.IO 開始一個會話，回傳（開始的連線, 開始的回應）；結束時取消並刪除會話"""
+    client = app.socketio.test_client(app.app)
+    payload = client.emit('start_conversation', SCENARIO, callback=True)
+    assert payload['success']
+    yield client, payload
+    session_id = payload['session_id']
+    app.conversation_scheduler.cancel(session_id, 'stopped', wait=5)
+    app.conversation_manager.delete_conversation(session_id)
+
+
+def test_start_returns_random_session_and_resume_token(started):
+    """會話 ID 是隨機產生而不是連線的 sid，開始的連線成為擁有者，回應附上簽署過的續接權杖"""
+    client, payload = started
+    session_id = payload['session_id']
+    sid = app.socketio.server.manager.sid_from_eio_sid(client.eio_sid, '/')
+    assert session_id != sid
+    assert payload['resume_token'] == app.resume_token(session_id)
+    assert app.session_owner(session_id) == sid
+
+
+def test_rejoin_before_old_disconnect_replaces_owner(started):
+    """舊連線還在線時新的連線就以權杖加入：直接成為擁有者，之後舊連線斷線不會暫停會話"""
+    old, payload = started
+    session_id = payload['session_id']
+    new = app.socketio.test_client(app.app)
+    
+    joined = new.emit('join_conversation', {
+        'session_id': session_id, 'resume_token': payload['resume_token'], 'last_seq': 0
+    }, callback=True)
+    assert joined['success']
+    assert old.emit('pause_conversation', {'session_id': session_id}, callback=True)['success'] is False
+    
+    old.disconnect()
+    assert app.conversation_manager.detached_at(session_id) is None
+    assert app.conversation_manager.conversations[session_id]['paused'] is None
+    
+    assert new.emit('pause_conversation', {'session_id': session_id}, callback=True)['success']
+    assert new.emit('resume_conversation', {'session_id': session_id}, callback=True)['success']
+    new.disconnect()
+    assert app.conversation_manager.detached_at(session_id) is not None
+
+
+def test_join_requires_resume_token(started):
+    """沒有權杖、權杖錯誤或屬於其他會話時不能加入，也就不能取代擁有者"""
+    _, payload = started
+    other = app.socketio.test_client(app.app)
+    for token in (None, 'x' * 64, app.resume_token('other-session')):
+        joined = other.emit('join_conversation', {'session_id': payload['session_id'], 'resume_token': token}, callback=True)
+        assert joined['success'] is False
+    other.disconnect()
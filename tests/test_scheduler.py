@@ -0,0 +1,209 @@
+"""
+模型呼叫准入排程（ModelCallScheduler）與 ConversationManager._call_model 的行為測試：
+輪替放行順序、排隊中取消、重試退避期間釋放名額、執行中取消時名額保留到執行緒結束，
+模型呼叫還在排隊的會話不會被閒置淘汰，以及重試用盡的回合不寫入替代訊息、繼續後重新生成。
+"""
+import asyncio
+import time
+
+import pytest
+
+import app
+
+
+class FlakyBackend(app.FakeModelBackend):
+    """前 failures 次呼叫拋出配額錯誤，之後照常回應"""
+    
+    def __init__(self, failures=0, latency='fixed:0'):
+        super().__init__(latency=latency, chunk_delay=0)
+        self.failures = failures
+        self.calls = 0
+    
+    def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise app.ResourceExhausted('429 測試注入的配額錯誤')
+        return super().generate_content(prompt, stream=stream, generation_config=generation_config, **kwargs)
+
+
+def make_manager(backend, max_model_calls=1):
+    manager = app.ConversationManager(max_model_calls=max_model_calls)
+    manager.models[manager.model_name_for('dialogue')] = backend
+    return manager
+
+
+def test_admission_round_robin():
+    """名額用完時各會話輪流放行，先送出大量呼叫的會話不會讓後來的會話一直等"""
+    async def scenario():
+        scheduler = app.ModelCallScheduler(max_concurrent=1)
+        order = []
+        
+        async def call(session_id, index):
+            await scheduler.acquire(session_id, 1)
+            order.append((session_id, index))
+            await asyncio.sleep(0)
+            scheduler.release()
+        
+        tasks = [asyncio.create_task(call('a', index)) for index in range(3)]
+        tasks += [asyncio.create_task(call(session_id, 0)) for session_id in ('b', 'c')]
+        await asyncio.gather(*tasks)
+        return order, scheduler.stats()
+    
+    order, stats = asyncio.run(scenario())
+    assert order == [('a', 0), ('a', 1), ('b', 0), ('c', 0), ('a', 2)]
+    assert stats['in_flight'] == 0 and stats['queued_calls'] == 0
+
+
+def test_cancel_while_queued():
+    """排隊中取消的呼叫從佇列移除，不佔名額，下一個排隊的呼叫照常放行"""
+    async def scenario():
+        scheduler = app.ModelCallScheduler(max_concurrent=1)
+        await scheduler.acquire('a', 1)
+        queued = asyncio.create_task(scheduler.acquire('b', 1))
+        waiting = asyncio.create_task(scheduler.acquire('c', 1))
+        await asyncio.sleep(0)
+        assert scheduler.stats()['queued_calls'] == 2
+        
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert list(scheduler.queues) == ['c']
+        
+        scheduler.release()
+        await asyncio.wait_for(waiting, 1)
+        return scheduler.stats()
+    
+    stats = asyncio.run(scenario())
+    assert stats['in_flight'] == 1 and stats['queued_calls'] == 0
+
+
+def test_cancel_after_admission_returns_slot():
+    """已放行但任務還沒繼續執行時被取消，名額立即歸還給下一個排隊的呼叫"""
+    async def scenario():
+        scheduler = app.ModelCallScheduler(max_concurrent=1)
+        await scheduler.acquire('a', 1)
+        admitted = asyncio.create_task(scheduler.acquire('b', 1))
+        waiting = asyncio.create_task(scheduler.acquire('c', 1))
+        await asyncio.sleep(0)
+        
+        scheduler.release() # 放行 b，但 b 的任務還沒有機會執行
+        admitted.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await admitted
+        await asyncio.wait_for(waiting, 1)
+        return scheduler.stats()
+    
+    stats = asyncio.run(scenario())
+    assert stats['in_flight'] == 1 and stats['queued_calls'] == 0
+
+
+def test_retry_backoff_releases_slot(monkeypatch):
+    """可重試的錯誤在退避期間不佔名額：唯一的名額先讓給其他會話，重試成功後名額全部歸還"""
+    monkeypatch.setattr(app, 'MODEL_RETRY_BASE_SECONDS', 0.2)
+    monkeypatch.setattr(app.random, 'uniform', lambda low, high: high)
+    backend = FlakyBackend(failures=1)
+    manager = make_manager(backend)
+    
+    async def scenario():
+        finished = []
+        
+        async def call(session_id):
+            text = await manager._call_model(f'{session_id} 的提示詞', session_id=session_id)
+            finished.append(session_id)
+            return text
+        
+        flaky = asyncio.create_task(call('flaky'))
+        await asyncio.sleep(0.05) # 第一次嘗試已失敗，正在退避
+        assert manager.call_scheduler.in_flight == 0
+        other = asyncio.create_task(call('other'))
+        texts = await asyncio.gather(flaky, other)
+        return finished, texts
+    
+    finished, texts = asyncio.run(scenario())
+    assert finished == ['other', 'flaky']
+    assert all(texts)
+    assert backend.calls == 3
+    assert manager.call_scheduler.in_flight == 0
+
+
+def test_cancel_in_flight_keeps_slot_until_thread_ends():
+    """執行中的呼叫被取消時立即結束等待，但名額要等執行緒真正結束才釋放，避免超出同時呼叫上限"""
+    manager = make_manager(FlakyBackend(latency='fixed:0.3'))
+    
+    async def scenario():
+        call = asyncio.create_task(manager._call_model('提示詞', session_id='a'))
+        await asyncio.sleep(0.1)
+        assert manager.call_scheduler.in_flight == 1
+        
+        cancelled_at = time.perf_counter()
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        assert time.perf_counter() - cancelled_at < 0.1
+        assert manager.call_scheduler.in_flight == 1
+        
+        await asyncio.sleep(0.4)
+        assert manager.call_scheduler.in_flight == 0
+    
+    asyncio.run(scenario())
+
+
+def test_evict_idle_keeps_session_with_queued_call(monkeypatch):
+    """模型呼叫還在排隊的會話（狀態仍是 pending）不會被淘汰；同樣閒置但沒有呼叫的已結束會話照常淘汰"""
+    manager = make_manager(FlakyBackend())
+    for session_id in ('queued', 'idle'):
+        manager.create_conversation(session_id, 'A', 'B', 'a', 'b', '主題', 50, 1, False)
+    manager.conversations['idle']['status'] = 'finished'
+    
+    async def scenario():
+        await manager.call_scheduler.acquire('holder', 1)
+        call = asyncio.create_task(manager._call_model('提示詞', session_id='queued'))
+        await asyncio.sleep(0.05)
+        assert manager.call_scheduler.stats()['queued_calls'] == 1
+        
+        monkeypatch.setattr(app, 'SESSION_IDLE_TTL_SECONDS', 1)
+        monkeypatch.setattr(app, 'MAX_STORED_SESSIONS', 0)
+        for conversation in manager.conversations.values():
+            conversation['last_active'] -= 60
+        manager.evict_idle()
+        assert 'queued' in manager.conversations
+        assert 'idle' not in manager.conversations
+        
+        manager.call_scheduler.release()
+        return await asyncio.wait_for(call, 1)
+    
+    assert asyncio.run(scenario())
+    assert manager.conversations['queued']['status'] == 'pending'
+
+
+def test_exhausted_retries_pause_without_placeholder(monkeypatch):
+    """重試用盡時不寫入道歉或旁白失敗的替代訊息：送出 generation_failed 並暫停，繼續後重新生成同一回合"""
+    monkeypatch.setattr(app, 'MODEL_MAX_RETRIES', 0)
+    monkeypatch.setattr(app, 'TURN_PACING_SECONDS', 0)
+    events = []
+    monkeypatch.setattr(app.socketio, 'emit', lambda event, data=None, **kwargs: events.append(event))
+    manager = app.conversation_manager
+    backend = FlakyBackend(failures=1)
+    monkeypatch.setitem(manager.models, manager.model_name_for('dialogue'), backend)
+    monkeypatch.setitem(manager.models, manager.model_name_for('narrator'), backend)
+    
+    session_id = 'generation-failed'
+    manager.create_conversation(session_id, 'A', 'B', 'a', 'b', '主題', 50, 1, True)
+    manager.conversations[session_id]['story_outline'] = '大綱'
+    future = app.conversation_scheduler.submit(session_id, app.run_conversation_background)
+    try:
+        deadline = time.time() + 5
+        while manager.conversations[session_id].get('paused') != 'generation_failed' and time.time() < deadline:
+            time.sleep(0.01)
+        assert manager.conversations[session_id]['paused'] == 'generation_failed'
+        assert 'generation_failed' in events
+        assert len(manager.conversations[session_id]['messages']) == 0
+        
+        assert app.conversation_scheduler.resume(session_id)
+        future.result(5)
+        conversation = manager.conversations[session_id]
+        assert conversation['status'] == 'finished'
+        assert [message.type for message in conversation['messages']] == ['dialogue', 'dialogue', 'narrator']
+        assert not any('抱歉' in message.content or '生成失敗' in message.content for message in conversation['messages'])
+    finally:
+        manager.delete_conversation(session_id)